@@ -7,17 +7,25 @@
    author: Ramon Fontes (ramonrf@dca.fee.unicamp.br)
 """
 
+import hashlib
 import heapq
+import json
+import os
+import signal
+import struct
 import networkx as nx
 import random
 import math
 import matplotlib.pyplot as plt
 import csv
 import configparser
-from threading import Thread as thread
-from time import sleep, time
+from bisect import bisect_left
+from threading import Thread as thread, Condition, Event, Lock, current_thread
+from time import time, monotonic, perf_counter
+from itertools import islice
 from os import system as sh, getpid
 from glob import glob
+from subprocess import Popen, PIPE
 import numpy as np
 from numpy.random import rand
 
@@ -25,28 +33,1149 @@ from mininet.log import debug
 from mn_wifi.link import mesh, adhoc, ITSLink, master
 from mn_wifi.associationControl import AssociationControl as AssCtrl
 from mn_wifi.plot import PlotGraph
-from mn_wifi.wmediumdConnector import w_cst, wmediumd_mode
-
-def export_mobility_trace_from_nodes(nodes, filename):
-    trace_entries = []
-    for node_id, node in enumerate(nodes):
-        # If the node has a recorded history in 'positions', iterate over it.
-        if hasattr(node, "positions") and node.positions:
-            for t, pos in node.positions:
-                if isinstance(pos, (tuple, list)):
-                    trace_entries.append((node_id, t, pos[0], pos[1]))
-                elif hasattr(pos, "x") and hasattr(pos, "y"):
-                    trace_entries.append((node_id, t, pos.x, pos.y))
-        else:
-            print("No recorded positions for node {}".format(node.name))
-    if not trace_entries:
+from mn_wifi.propagationModels import PropagationModel as ppm
+from mn_wifi.wmediumdConnector import w_cst, w_server, wmediumd_mode
+from mn_wifi.traceFormats import CSVFrameWriter, TraceStreamer, BinaryTrace, \
+    BinaryFrameWriter, CompressedTrace, CompressedRowWriter, frame_writer
+
+def export_mobility_trace_from_nodes(nodes, filename, trace_format=None):
+    """:param trace_format: 'csv', or 'compressed' ('zlib' or 'lzma' for a
+    given codec) for a CompressedTrace; by default 'compressed' if the
+    file name ends in .mnz"""
+    history = Mobility.history
+    if history is None or not len(history):
         print("No mobility trace data found!")
         return
-
-    with open(filename, "w", buffering=1) as f:
+    if trace_format is None:
+        trace_format = 'compressed' if filename.endswith(CompressedTrace.extension) else 'csv'
+    t, node_col, xyz = history.columns()
+    order = np.argsort(node_col, kind='stable')
+    bounds = np.searchsorted(node_col[order], np.arange(len(history.last) + 1))
+    if trace_format == 'csv':
+        f = open(filename, "w")
         f.write("node_id,time,x,y\n")
-        for entry in trace_entries:
-            f.write("{},{:.2f},{:.2f},{:.2f}\n".format(entry[0], entry[1], entry[2], entry[3]))
+    else:
+        codec = 'zlib' if trace_format == 'compressed' else trace_format
+        writer = CompressedRowWriter(filename, [node.name for node in nodes], codec=codec)
+    try:
+        for node_id, node in enumerate(nodes):
+            idx = history.nodes.get(node)
+            if idx is None:
+                print("No recorded positions for node {}".format(node.name))
+                continue
+            rows = order[bounds[idx]:bounds[idx + 1]]
+            if trace_format != 'csv':
+                writer.write_rows(node_id, t[rows], xyz[rows, :2])
+                continue
+            table = np.empty((len(rows), 4))
+            table[:, 0] = node_id
+            table[:, 1] = t[rows]
+            table[:, 2:] = xyz[rows, :2]
+            np.savetxt(f, table, fmt='%d,%.2f,%.2f,%.2f')
+    finally:
+        if trace_format == 'csv':
+            f.close()
+        else:
+            writer.close()
+
+
+class TickHistogram(object):
+    "Fixed-size histogram of durations, power-of-two buckets from 1us"
+    edges = [1e-6 * 2 ** n for n in range(27)]  # 1us .. ~67s
+
+    def __init__(self):
+        self.counts = [0] * (len(self.edges) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        self.counts[bisect_left(self.edges, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        "Upper bound of the bucket holding the q-th quantile"
+        target = q * self.count
+        acc = 0
+        for idx, n in enumerate(self.counts):
+            acc += n
+            if n and acc >= target:
+                return min(self.edges[idx], self.max) \
+                    if idx < len(self.edges) else self.max
+        return 0.0
+
+    def summary(self):
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else 0.0,
+                'p50': self.percentile(0.5), 'p90': self.percentile(0.9),
+                'p99': self.percentile(0.99), 'max': self.max}
+
+
+class Gauge(object):
+    "Last, mean and max of a sampled level, e.g. a buffer depth"
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0
+        self.last = 0
+
+    def record(self, value):
+        self.count += 1
+        self.total += value
+        self.last = value
+        if value > self.max:
+            self.max = value
+
+    def summary(self):
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else 0.0,
+                'max': self.max, 'last': self.last}
+
+
+class MobilityStats(object):
+    """Opt-in per-tick timing of the mobility and link threads.
+    Phases: step (generator), commit (set_pos/wmediumd), plot, link
+    (config_links pass), lateness (behind the clock schedule) and
+    prefetch_wait (commit loop waiting for the prefetch thread).
+    Gauges: prefetch_depth (frames buffered ahead of the commit loop)"""
+    phases = ('step', 'commit', 'plot', 'link', 'lateness', 'prefetch_wait')
+    gauge_names = ('prefetch_depth',)
+    enabled = False
+    histograms = {}
+    gauges = {}
+    link_passes = 0
+    last_snapshot = (0.0, 0)  # (perf_counter, link_passes)
+    dump_thread = None
+    dump_stop = Event()
+
+    @classmethod
+    def reset(cls):
+        cls.histograms = {phase: TickHistogram() for phase in cls.phases}
+        cls.gauges = {name: Gauge() for name in cls.gauge_names}
+        cls.link_passes = 0
+        cls.last_snapshot = (perf_counter(), 0)
+
+    @classmethod
+    def enable(cls, filename=None, interval=10.0):
+        """:param filename: periodic dump file; .csv or JSON lines otherwise
+        :param interval: seconds between two dumps"""
+        cls.stop_dump()  # enabled again: the new dump replaces the old one
+        cls.reset()
+        cls.enabled = True
+        if filename:
+            cls.dump_stop.clear()
+            cls.dump_thread = thread(name='mobStats', target=cls.dump_loop,
+                                     args=(filename, interval))
+            cls.dump_thread.daemon = True
+            cls.dump_thread.start()
+
+    @classmethod
+    def disable(cls):
+        cls.enabled = False
+        cls.stop_dump()
+
+    @classmethod
+    def stop_dump(cls):
+        if cls.dump_thread:
+            cls.dump_stop.set()
+            cls.dump_thread.join()
+            cls.dump_thread = None
+
+    @classmethod
+    def record(cls, phase, value):
+        cls.histograms[phase].record(value)
+
+    @classmethod
+    def gauge(cls, name, value):
+        cls.gauges[name].record(value)
+
+    @classmethod
+    def lap(cls, phase, since):
+        "Records the time elapsed since `since' and returns the current time"
+        now = perf_counter()
+        cls.histograms[phase].record(now - since)
+        return now
+
+    @classmethod
+    def link_pass(cls, since):
+        cls.lap('link', since)
+        cls.link_passes += 1
+
+    @classmethod
+    def snapshot(cls):
+        now = perf_counter()
+        last_time, last_passes = cls.last_snapshot
+        cls.last_snapshot = (now, cls.link_passes)
+        elapsed = now - last_time
+        rate = (cls.link_passes - last_passes) / elapsed if elapsed > 0 else 0.0
+        return {'time': time(), 'link_passes': cls.link_passes,
+                'link_passes_per_s': rate,
+                'phases': {phase: hist.summary()
+                           for phase, hist in cls.histograms.items()},
+                'gauges': {name: gauge.summary()
+                           for name, gauge in cls.gauges.items()},
+                'counters': {'wmediumd_positions': WmediumdPositions.messages,
+                             'wmediumd_positions_suppressed': WmediumdPositions.suppressed,
+                             'snr_updates': SNRUpdates.sent,
+                             'snr_updates_suppressed': SNRUpdates.suppressed,
+                             'tc_commands': TCBatch.commands,
+                             'tc_batches': TCBatch.batches,
+                             'tc_dropped': TCBatch.dropped}}
+
+    @classmethod
+    def dump(cls, filename):
+        snapshot = cls.snapshot()
+        if filename.endswith('.csv'):
+            new = not os.path.exists(filename)
+            with open(filename, 'a') as f:
+                writer = csv.writer(f)
+                if new:
+                    writer.writerow(['time', 'phase', 'count', 'mean', 'p50',
+                                     'p90', 'p99', 'max', 'link_passes_per_s'])
+                rows = list(snapshot['phases'].items()) + \
+                    list(snapshot['gauges'].items())
+                for phase, summary in rows:
+                    writer.writerow([snapshot['time'], phase] +
+                                    [summary.get(key, '') for key in
+                                     ('count', 'mean', 'p50', 'p90', 'p99', 'max')] +
+                                    [snapshot['link_passes_per_s']])
+        else:
+            with open(filename, 'a') as f:
+                f.write(json.dumps(snapshot) + '\n')
+
+    @classmethod
+    def dump_loop(cls, filename, interval):
+        while not cls.dump_stop.wait(interval):
+            cls.dump(filename)
+        cls.dump(filename)
+
+
+class WmediumdPositions(object):
+    """Position updates for wmediumd in interference mode. A node that
+    moved no more than epsilon since its last update is not sent, and the
+    updates of a mobility tick go out in one write on the wmediumd
+    socket, their replies being read back afterwards"""
+    epsilon = 0.0  # m
+    sock = None  # socket to wmediumd; None uses the w_server connection
+    # w_server's own structs: type, mac, x, y, z and
+    # type, the request echoed (with its type), result
+    request = getattr(w_server, '_w_server__pos_update_request_struct',
+                      None) or struct.Struct('!B6sfff')
+    response = getattr(w_server, '_w_server__pos_update_response_struct',
+                       None) or struct.Struct('!BB6sfffB')
+    lock = Lock()  # guards the queue
+    batching = False
+    pending = {}  # node -> position queued during the tick
+    sent = {}  # node -> last position sent
+    messages = 0  # interface position updates sent
+    writes = 0  # socket writes, or set_pos_wmediumd calls without a socket
+    suppressed = 0  # updates within epsilon
+
+    @classmethod
+    def reset(cls):
+        with cls.lock:
+            cls.pending, cls.sent = {}, {}
+            cls.messages = cls.writes = cls.suppressed = 0
+
+    @staticmethod
+    def distance(src, dst):
+        return math.sqrt(sum((float(a) - float(b)) ** 2
+                             for a, b in zip(src[:3], dst[:3])))
+
+    @classmethod
+    def update(cls, node, pos):
+        "Queues the position, or sends it right away outside of a tick"
+        with cls.lock:
+            last = cls.sent.get(node)
+            if last is not None and cls.distance(last, pos) <= cls.epsilon:
+                cls.suppressed += 1
+                return
+            cls.pending[node] = pos
+            if cls.batching:
+                return
+            updates, cls.pending = cls.pending, {}
+        cls.send(updates)
+
+    @classmethod
+    def begin(cls):
+        "Starts queueing updates until flush"
+        with cls.lock:
+            cls.batching = True
+
+    @classmethod
+    def flush(cls):
+        "Sends the updates queued since begin"
+        with cls.lock:
+            cls.batching = False
+            updates, cls.pending = cls.pending, {}
+        if updates:
+            cls.send(updates)
+
+    @classmethod
+    def send(cls, updates):
+        """:param updates: dict node -> position"""
+        sock = cls.sock if cls.sock is not None else getattr(w_server, 'sock', None)
+        if sock is None:
+            for node, pos in updates.items():
+                node.set_pos_wmediumd(pos)
+                cls.messages += len(getattr(node, 'wmIfaces', ()))
+                cls.writes += 1
+        else:
+            requests = []
+            for node, pos in updates.items():
+                x, y, z = [float(c) for c in pos[:3]]
+                # as set_pos_wmediumd: each interface sits 1 m further on x
+                for id, wm_intf in enumerate(getattr(node, 'wmIfaces', ())):
+                    mac = bytes.fromhex(wm_intf.get_intf_mac().replace(':', ''))
+                    requests.append(cls.request.pack(
+                        w_cst.WSERVER_POSITION_UPDATE_REQUEST_TYPE, mac,
+                        x + id, y, z))
+                node.lastpos = pos
+            if requests:
+                sock.sendall(b''.join(requests))
+                cls.read_responses(sock, len(requests))
+                cls.messages += len(requests)
+                cls.writes += 1
+        cls.sent.update(updates)
+
+    @classmethod
+    def read_responses(cls, sock, count):
+        size = cls.response.size * count
+        data = bytearray()
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise IOError('wmediumd closed the connection')
+            data += chunk
+        for reply in cls.response.iter_unpack(bytes(data)):
+            if reply[-1] != w_cst.WUPDATE_SUCCESS:
+                debug('wmediumd position update failed: %s\n' % reply[-1])
+
+
+class SNRUpdates(object):
+    """SNR updates for wmediumd in SNR mode. A value is sent only if it
+    differs by more than delta (dB) from the last one sent for the pair,
+    and at most once per interval (s). Updates going out of or back into
+    range only skip repeated values"""
+    delta = 0.0
+    interval = 0.0
+    last = {}  # (intf, ap_intf) -> (snr, monotonic time sent, out of range)
+    sent = 0
+    suppressed = 0
+
+    @classmethod
+    def reset(cls):
+        cls.last = {}
+        cls.sent = cls.suppressed = 0
+
+    @classmethod
+    def update(cls, intf, ap_intf, snr, out_of_range=False):
+        """returns: True if the update was sent"""
+        key = (intf, ap_intf)
+        now = monotonic()
+        last = cls.last.get(key)
+        if last is not None:
+            last_snr, last_time, was_out_of_range = last
+            if out_of_range or was_out_of_range:
+                skip = snr == last_snr
+            else:
+                skip = abs(snr - last_snr) <= cls.delta or \
+                    now - last_time < cls.interval
+            if skip:
+                cls.suppressed += 1
+                return False
+        cls.last[key] = (snr, now, out_of_range)
+        cls.sent += 1
+        intf.setSNRWmediumd(ap_intf, snr)
+        return True
+
+
+class LinkScheduler(object):
+    """Decides when each station next needs a link pass. A station can
+    not reach an AP range edge before its distance to the nearest edge
+    divided by its speed; stations that move meanwhile are queued and
+    evaluated once that time has come"""
+    enabled = False
+    min_interval = 0.1  # s
+    max_interval = 1.0  # s, also bounds the staleness of rssi values
+    margin = 2.0  # speed-up a station may have before its next pass
+
+    def __init__(self):
+        self.due = {}  # station -> monotonic time it next needs a pass
+        self.last = {}  # station -> (time, position) of its last pass
+        self.queue = []  # (due, seq, station) heap of stations that moved
+        self.queued = set()
+        self.seq = 0
+
+    def timeout(self):
+        "Seconds until the next queued station is due"
+        if not self.queue:
+            return None
+        return max(self.queue[0][0] - monotonic(), 0)
+
+    def expire(self):
+        "Range edges moved with an AP: every station is due again"
+        self.due.clear()
+
+    def select(self, stations):
+        """:param stations: stations that moved
+        returns: the stations due now, queued ones included"""
+        now = monotonic()
+        ready = set()
+        while self.queue and self.queue[0][0] <= now:
+            sta = heapq.heappop(self.queue)[2]
+            self.queued.discard(sta)
+            ready.add(sta)
+        for sta in stations:
+            due = self.due.get(sta, 0)
+            if due <= now:
+                ready.add(sta)
+            elif sta not in self.queued:
+                self.queued.add(sta)
+                heapq.heappush(self.queue, (due, self.seq, sta))
+                self.seq += 1
+        return ready
+
+    def schedule(self, links):
+        """Sets when the stations of a pass next need one
+        :param links: LinkMatrix of the pass"""
+        now = monotonic()
+        slack = links.slack()
+        for sta, row in links.rows.items():
+            pos = [float(c) for c in sta.position[:3]]
+            last = self.last.get(sta)
+            self.last[sta] = (now, pos)
+            interval = self.min_interval
+            if last is not None and now > last[0]:
+                speed = math.sqrt(sum((a - b) ** 2 for a, b in zip(pos, last[1]))) \
+                    / (now - last[0])
+                interval = slack[row] / (speed * self.margin) if speed else self.max_interval
+            self.due[sta] = now + min(max(interval, self.min_interval), self.max_interval)
+
+
+class HandoverPredictor(object):
+    """Event-driven link passes for models that expose the linear segment
+    each node is on (segments(): start time, position, velocity, end time).
+    The times a station crosses an AP range edge are solved for once per
+    segment and the station gets its pass right then, at the position the
+    segment gives for that instant, instead of on every frame. Times are
+    model times; passes never run ahead of the last frame by more than
+    one timestep"""
+    enabled = False
+    guard = 0.001  # s past a crossing, so that the station is over the edge
+    refresh = 1.0  # s, bounds the staleness of rssi values
+    tolerance = 1e-3  # m, frame to frame drift of an unchanged segment
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.lock = Lock()
+        self.published = 0.0  # model time of the last frame
+        self.segments = {}  # station -> (t0, p0, v, t1), p0 and v as 3-tuples
+        self.changed = set()  # stations whose segment changed since their pass
+        self.events = []  # (model time, seq, station) heap
+        self.due = {}  # station -> seq of its pending event
+        self.seq = 0
+
+    def now(self):
+        if self.clock.origin is None:
+            # before the first frame (e.g. during mob_start_time): nothing
+            # is predicted yet, so every moved station gets its pass
+            return self.published
+        wall, frame = self.clock.origin
+        t = self.clock.frame_time(frame) + (monotonic() - wall) * self.clock.rt_factor
+        return min(t, self.published + self.clock.timestep)
+
+    @staticmethod
+    def position(segment, t):
+        t0, p0, v, t1 = segment
+        dt = min(max(t, t0), t1) - t0
+        return [p + u * dt for p, u in zip(p0, v)]
+
+    def same(self, old, new):
+        "Whether new continues old, e.g. published again one frame later"
+        if old[2] != new[2] or abs(old[3] - new[3]) > 1e-6:
+            return False
+        pos = self.position(old, new[0])
+        return all(abs(a - b) <= self.tolerance for a, b in zip(pos, new[1]))
+
+    def publish(self, nodes, segments, t):
+        """Takes the segments of the frame just committed
+        :param segments: per node, (t0, (x, y), (vx, vy), t1)
+        :param t: model time of the frame
+        returns: the stations whose segment changed"""
+        changed = []
+        with self.lock:
+            self.published = t
+            for node, (t0, p0, v, t1) in zip(nodes, segments):
+                segment = (t0, (p0[0], p0[1], 0.0), (v[0], v[1], 0.0), t1)
+                old = self.segments.get(node)
+                if old is None or not self.same(old, segment):
+                    self.segments[node] = segment
+                    self.changed.add(node)
+                    changed.append(node)
+        return changed
+
+    def timeout(self):
+        "Wall-clock seconds until the next event"
+        if not self.events:
+            return None
+        return max(self.events[0][0] - self.now(), 0) / self.clock.rt_factor
+
+    def expire(self):
+        "Range edges moved with an AP: every prediction is redone"
+        with self.lock:
+            self.changed.update(self.segments)
+
+    def select(self, stations):
+        """:param stations: stations that moved
+        returns: the stations that need a pass now, and dict station ->
+        position to evaluate the predicted ones at"""
+        now = self.now()
+        with self.lock:
+            ready = {sta for sta in stations if sta not in self.segments}
+            ready |= self.changed
+            while self.events and self.events[0][0] <= now:
+                seq, sta = heapq.heappop(self.events)[1:]
+                if self.due.get(sta) == seq:
+                    ready.add(sta)
+            self.changed -= ready
+            positions = {sta: self.position(self.segments[sta], now)
+                         for sta in ready if sta in self.segments}
+        return ready, positions
+
+    def crossings(self, pos, vel, index):
+        """Model seconds until each station next crosses a range edge
+        :param pos: stations x 3 positions
+        :param vel: stations x 3 velocities"""
+        if not index.intfs:
+            return np.full(len(pos), np.inf)
+        # |pos + vel * s - ap| = edge; distances are rounded to cm before
+        # being compared with the range, which moves the edge by 5 mm
+        edge = index.ranges + 0.005
+        d = pos[:, None, :] - index.positions[index.intf_aps][None, :, :]
+        with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+            a = (vel ** 2).sum(axis=1)[:, None]
+            b = 2 * (d * vel[:, None, :]).sum(axis=2)
+            c = (d ** 2).sum(axis=2) - edge ** 2
+            disc = b ** 2 - 4 * a * c
+            root = np.sqrt(np.where(disc > 0, disc, 0))
+            s1 = (-b - root) / (2 * a)
+            s2 = (-b + root) / (2 * a)
+            s = np.where(s1 > 0, s1, s2)
+            s[~((a > 0) & (disc > 0) & (s > 0) & np.isfinite(s))] = np.inf
+        return s.min(axis=1)
+
+    def schedule(self, links):
+        """Sets the next event of the predicted stations of a pass: the
+        first range crossing within their segment, or the refresh
+        :param links: LinkMatrix of the pass"""
+        now = self.now()
+        with self.lock:
+            stations = [sta for sta in links.rows if sta in self.segments]
+            if not stations:
+                return
+            segments = [self.segments[sta] for sta in stations]
+            pos = np.array([self.position(seg, now) for seg in segments])
+            vel = np.array([seg[2] for seg in segments], dtype=float)
+            crossing = self.crossings(pos, vel, links.index)
+            for sta, seg, s in zip(stations, segments, crossing.tolist()):
+                when = now + self.refresh
+                if now + s <= seg[3]:
+                    when = min(when, now + s + self.guard)
+                self.seq += 1
+                self.due[sta] = self.seq
+                heapq.heappush(self.events, (when, self.seq, sta))
+
+
+class TCBatch(object):
+    """Link shaping changes of one link pass, applied with one tc -batch
+    per network namespace. The tc replace/change commands a node runs
+    while a change is recorded are captured instead, other commands
+    still run; only the latest replace/change of each qdisc, class or
+    filter is kept, and those identical to the last one applied are
+    dropped"""
+    enabled = True
+    applied = {}  # (node name, object key) -> last command applied
+    commands = 0  # tc commands run
+    batches = 0  # tc -batch invocations
+    dropped = 0  # superseded or unchanged commands
+    shell_chars = set(';|&<>`$')
+
+    def __init__(self):
+        self.pending = {}  # namespace node (None: root) -> {key: command}
+        self.nodes = {}  # namespace node -> node name for applied
+        self.seq = 0
+
+    @classmethod
+    def reset(cls):
+        "Forgets the applied commands, e.g. when the network is rebuilt"
+        cls.applied = {}
+
+    def key(self, line):
+        "What a tc command configures; unique for commands that add or delete"
+        words = line.split()
+        if len(words) < 3 or words[2] not in ('replace', 'change'):
+            self.seq += 1
+            return ('seq', self.seq)
+        key = [words[1]]
+        for opt in ('dev', 'parent', 'handle', 'classid'):
+            if opt in words[:-1]:
+                key.append((opt, words[words.index(opt) + 1]))
+        if 'root' in words:
+            key.append('root')
+        return tuple(key)
+
+    def add(self, node, line):
+        ns = node if getattr(node, 'inNamespace', True) else None
+        commands = self.pending.setdefault(ns, {})
+        key = self.key(line)
+        if key in commands:
+            TCBatch.dropped += 1
+        commands[key] = line
+        self.nodes[ns] = node.name if ns is not None else ''
+
+    def record(self, node, call, *args, **kwargs):
+        "Runs call with the tc commands of node captured"
+        cmd, pexec = node.cmd, node.pexec
+
+        def capture(run, result):
+            def wrapper(*cmd_args, **cmd_kwargs):
+                line = ' '.join(str(arg) for arg in cmd_args).strip()
+                words = line.split()
+                # anything but a replace/change (e.g. show) runs right away
+                if words[:1] == ['tc'] and words[2:3] in (['replace'], ['change']) \
+                        and not self.shell_chars & set(line):
+                    self.add(node, line)
+                    return result
+                return run(*cmd_args, **cmd_kwargs)
+            return wrapper
+
+        node.cmd = capture(cmd, '')
+        node.pexec = capture(pexec, ('', '', 0))
+        try:
+            return call(*args, **kwargs)
+        finally:
+            del node.cmd, node.pexec
+
+    def flush(self):
+        "Runs the recorded changes"
+        for ns, commands in self.pending.items():
+            lines = {}
+            for key, line in commands.items():
+                last = (self.nodes[ns], key)
+                if key[0] != 'seq' and self.applied.get(last) == line:
+                    TCBatch.dropped += 1
+                    continue
+                lines[last] = line
+            # a failed batch is run again in full by the next change
+            if lines and self.run_batch(ns, list(lines.values())):
+                self.applied.update(lines)
+        self.pending = {}
+
+    @classmethod
+    def run_batch(cls, node, lines):
+        """:param node: node whose namespace runs the batch, None for root
+        :param lines: tc commands
+        returns: True if every command succeeded"""
+        script = ''.join(line[3:].lstrip() + '\n' for line in lines)
+        args = ['tc', '-force', '-batch', '-']
+        popen = Popen if node is None else node.popen
+        proc = popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                     universal_newlines=True)
+        _, err = proc.communicate(script)
+        if proc.returncode:
+            debug('tc -batch failed in %s: %s\n' % (node or 'root namespace', err))
+        cls.commands += len(lines)
+        cls.batches += 1
+        return not proc.returncode
+
+
+class WpaSupplicants(object):
+    """wpa_supplicant processes of the stations, found through their
+    pidfiles and signalled in-process. Tearing one down on handover used
+    to fork a pkill and a rm shell"""
+    in_process = True  # False runs the former shell commands
+    pids = {}  # pidfile -> pid last read from it
+
+    @staticmethod
+    def cmdline(pid):
+        try:
+            with open('/proc/%d/cmdline' % pid, 'rb') as f:
+                return f.read().decode(errors='replace').split('\0')[:-1]
+        except OSError:
+            return None
+
+    @staticmethod
+    def matches(argv, pidfile, intf_name):
+        "Whether pkill -f 'wpa_supplicant ... -P pidfile -i intf' matches"
+        if not argv or os.path.basename(argv[0]) != 'wpa_supplicant':
+            return False
+        args = set(zip(argv, argv[1:]))
+        return ('-P', pidfile) in args and ('-i', intf_name) in args
+
+    @staticmethod
+    def read_pidfile(pidfile):
+        try:
+            with open(pidfile) as f:
+                return int(f.read().split()[0])
+        except (OSError, ValueError, IndexError):
+            return None
+
+    @classmethod
+    def scan(cls, pidfile, intf_name):
+        "Processes whose pidfile is gone, as pkill would find them"
+        pids = []
+        for entry in os.listdir('/proc'):
+            if entry.isdigit() and cls.matches(cls.cmdline(int(entry)),
+                                               pidfile, intf_name):
+                pids.append(int(entry))
+        return pids
+
+    @classmethod
+    def find(cls, pidfile, intf_name):
+        for pid in (cls.pids.get(pidfile), cls.read_pidfile(pidfile)):
+            if pid and cls.matches(cls.cmdline(pid), pidfile, intf_name):
+                cls.pids[pidfile] = pid
+                return [pid]
+        cls.pids.pop(pidfile, None)
+        return cls.scan(pidfile, intf_name)
+
+    @classmethod
+    def kill(cls, pidfile, intf_name):
+        "Terminates the wpa_supplicant of the interface"
+        if not cls.in_process:
+            sh('pkill -f \'wpa_supplicant -B -Dnl80211 -P %s -i %s\'' % (pidfile, intf_name))
+            return
+        for pid in cls.find(pidfile, intf_name):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass  # already gone
+        cls.pids.pop(pidfile, None)
+
+    @classmethod
+    def remove(cls, filename):
+        if not cls.in_process:
+            sh('rm %s >/dev/null 2>&1' % filename)
+            return
+        try:
+            os.unlink(filename)
+        except OSError:
+            pass
+
+
+class LinkPlan(object):
+    """The interfaces link passes work on, sorted out once per node so
+    that passes do no type dispatch. Dropped through
+    Mobility.invalidate_link_plan when nodes are added or removed"""
+
+    def __init__(self):
+        self.stations = {}  # station -> infrastructure interfaces
+        self.aps = {}  # ap -> (all, range checked, master interfaces)
+
+    def station_intfs(self, sta):
+        intfs = self.stations.get(sta)
+        if intfs is None:
+            intfs = self.stations[sta] = [
+                intf for intf in sta.wintfs.values()
+                if not isinstance(intf, adhoc) and not isinstance(intf, mesh)
+                and not isinstance(intf, ITSLink)]
+        return intfs
+
+    def get_ap(self, ap):
+        intfs = self.aps.get(ap)
+        if intfs is None:
+            wintfs = list(ap.wintfs.values())
+            intfs = self.aps[ap] = (
+                wintfs,
+                [intf for intf in wintfs
+                 if not isinstance(intf, adhoc) and not isinstance(intf, mesh)],
+                [intf for intf in wintfs if isinstance(intf, master)])
+        return intfs
+
+    def ap_intfs(self, ap):
+        "Interfaces whose range is checked"
+        return self.get_ap(ap)[1]
+
+    def masters(self, ap):
+        return self.get_ap(ap)[2]
+
+
+class APIndex(object):
+    """AP positions and interface ranges as arrays: the columns of the
+    link matrix, on a uniform grid. Cells are as wide as the largest AP
+    range, so an AP can only reach stations in its own cell or in one of
+    the eight around it. Rebuilt only when an AP is added, removed or moved"""
+
+    def __init__(self, aps, plan, grid=True):
+        """:param grid: narrow stations down to the APs of the cells
+        around them; without it every AP is a candidate"""
+        self.aps = list(aps)
+        self.plan = plan
+        self.grid = grid
+        self.ap_set = set(self.aps)
+        self.state = self.get_state(self.aps)
+        # APs without a position are never in range
+        self.positions = np.array(
+            [[float(c) for c in ap.position[:3]] if getattr(ap, 'position', None)
+             else [np.inf] * 3 for ap in self.aps]).reshape(-1, 3)
+        self.intfs = [intf for ap in self.aps for intf in plan.ap_intfs(ap)]
+        self.columns = {intf: col for col, intf in enumerate(self.intfs)}
+        self.intf_aps = np.array([self.aps.index(intf.node) for intf in self.intfs],
+                                 dtype=int)
+        self.ranges = np.array([intf.range for intf in self.intfs], dtype=float)
+        # the interfaces of an AP are consecutive columns
+        self.nr_intfs = np.bincount(self.intf_aps, minlength=len(self.aps))
+        self.first_col = np.cumsum(self.nr_intfs) - self.nr_intfs
+        # distances are rounded to cm before being compared with the
+        # range: the margin keeps APs past the cells around out of range
+        self.cell = max(float(self.ranges.max()), 0.0) + 0.01 \
+            if len(self.ranges) else 1.0
+        self.cells = {}
+        for idx in np.flatnonzero(np.isfinite(self.positions[:, 0])).tolist():
+            self.cells.setdefault(self.key(self.positions[idx]), []).append(idx)
+        self.candidates = {}  # cell -> APs that may reach it
+
+    @staticmethod
+    def get_state(aps):
+        return [(ap, tuple(getattr(ap, 'position', None) or ()),
+                 tuple(intf.range for intf in ap.wintfs.values()))
+                for ap in aps]
+
+    def is_valid(self, aps, plan, grid=True):
+        "Whether no AP was added, removed, moved or had its range changed"
+        return self.plan is plan and self.grid == grid \
+            and self.state == self.get_state(aps)
+
+    def key(self, pos):
+        return (int(math.floor(pos[0] / self.cell)),
+                int(math.floor(pos[1] / self.cell)))
+
+    def get_candidates(self, key):
+        """:param key: grid cell, None for every AP
+        returns: the APs that may reach the cell, in AP order"""
+        aps = self.candidates.get(key)
+        if aps is None:
+            if key is None:
+                aps = np.arange(len(self.aps))
+            else:
+                cx, cy = key
+                aps = np.array(sorted(idx for x in (cx - 1, cx, cx + 1)
+                                      for y in (cy - 1, cy, cy + 1)
+                                      for idx in self.cells.get((x, y), ())),
+                               dtype=int)
+            self.candidates[key] = aps
+        return aps
+
+    def edge_distance(self, pos):
+        """Distance of each position to the edge of its cell: APs the grid
+        leaves out are at least that much further than their range"""
+        if not self.grid:
+            return np.full(len(pos), np.inf)
+        offset = pos[:, :2] - np.floor(pos[:, :2] / self.cell) * self.cell
+        return np.minimum(offset, self.cell - offset).min(axis=1)
+
+
+class LinkMatrix(object):
+    """Station x AP distances and in-range masks for one link pass, kept
+    for the pairs the AP grid leaves in (APs left out are out of range)
+    and computed in one go from the node positions. The pairs of a
+    station are consecutive, in AP order"""
+
+    def __init__(self, stations, index, positions=None):
+        """:param stations: stations of this pass, one row each
+        :param index: APIndex
+        :param positions: dict station -> position, if not node.position"""
+        self.index = index
+        self.rows = {sta: row for row, sta in enumerate(stations)}
+        positions = positions or {}
+        self.pos = np.array([positions.get(sta) or [float(c) for c in sta.position[:3]]
+                             for sta in stations], dtype=float).reshape(-1, 3)
+        if index.grid and len(stations):
+            keys, inverse = np.unique(np.floor(self.pos[:, :2] / index.cell)
+                                      .astype(np.int64), axis=0, return_inverse=True)
+            keys = [tuple(key) for key in keys.tolist()]
+        else:
+            keys, inverse = [None], np.zeros(len(stations), dtype=int)
+        inverse = inverse.ravel()
+        candidates = [index.get_candidates(key) for key in keys]
+        sizes = np.array([len(aps) for aps in candidates], dtype=int)
+        offsets = np.cumsum(sizes) - sizes
+        flat = np.concatenate(candidates + [np.zeros(0, dtype=int)])
+        # station x candidate AP pairs
+        counts = sizes[inverse]
+        self.pair_rows = np.repeat(np.arange(len(stations)), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        self.pair_aps = flat[np.repeat(offsets[inverse], counts) + local]
+        sq = ((self.pos[self.pair_rows] - index.positions[self.pair_aps]) ** 2).sum(axis=1)
+        # same rounding as Node.get_distance_to
+        self.dist = np.round(np.sqrt(sq), 2)
+        # the same pairs, one per AP interface
+        nr_intfs = index.nr_intfs[self.pair_aps]
+        pairs = np.repeat(np.arange(len(self.pair_aps)), nr_intfs)
+        local = np.arange(len(pairs)) - np.repeat(np.cumsum(nr_intfs) - nr_intfs, nr_intfs)
+        self.col_pairs = pairs
+        self.cols = index.first_col[self.pair_aps][pairs] + local
+        self.in_range = self.dist[pairs] <= index.ranges[self.cols]
+        in_rows = self.pair_rows[pairs[self.in_range]]
+        self.in_ptr = np.concatenate(
+            ([0], np.cumsum(np.bincount(in_rows, minlength=len(stations)))))
+        self.in_cols = self.cols[self.in_range]
+        self.in_dist = self.dist[pairs[self.in_range]]
+
+    def in_range_cols(self, sta):
+        "returns: the AP interface columns in range of the station, in order"
+        row = self.rows[sta]
+        return self.in_cols[self.in_ptr[row]:self.in_ptr[row + 1]].tolist()
+
+    def aps_in_range(self, sta):
+        "returns: dict AP -> distance, in AP order"
+        row = self.rows[sta]
+        lo, hi = self.in_ptr[row], self.in_ptr[row + 1]
+        aps = {}
+        for col, dist in zip(self.in_cols[lo:hi].tolist(), self.in_dist[lo:hi].tolist()):
+            aps.setdefault(self.index.aps[self.index.intf_aps[col]], dist)
+        return aps
+
+    def distances(self, sta):
+        "returns: the distance of the station to every AP, for scanning stations"
+        sq = ((self.pos[self.rows[sta]] - self.index.positions) ** 2).sum(axis=1)
+        return np.round(np.sqrt(sq), 2)
+
+    def slack(self):
+        """returns: per station, how far it is from the nearest AP range
+        edge, or a lower bound of it"""
+        slack = self.index.edge_distance(self.pos)
+        np.minimum.at(slack, self.pair_rows[self.col_pairs],
+                      np.abs(self.dist[self.col_pairs] - self.index.ranges[self.cols]))
+        return slack
+
+
+class RSSIKernels(object):
+    """Vectorized PropagationModel formulas: one call gives the RSSI of
+    every pair of a link pass. Each kernel is checked once against
+    intf.get_rssi; models without a matching kernel use get_rssi"""
+    light_speed = 299792458.0
+    use_table = False  # interpolate on precomputed RSSI-vs-distance tables
+    table_step = 0.01  # m, the resolution of the link distances
+    tables = {}  # model and pair parameters -> (distances, rssi)
+    checked = {}  # model parameters -> kernel, None if it disagrees
+
+    @staticmethod
+    def model_params():
+        return (ppm.model, ppm.exp, ppm.sL, ppm.lF, ppm.pL, ppm.nFloors)
+
+    @classmethod
+    def path_loss(cls, freq, dist):
+        wavelength = cls.light_speed / (freq * 10 ** 9)
+        return 10 * np.log10((4 * np.pi * dist) ** 2 * ppm.sL / wavelength ** 2)
+
+    @classmethod
+    def kernel_friis(cls, dist, pt, gt, gr, freq):
+        dist = np.where(dist == 0, 0.1, dist)
+        return pt + gt + gr - cls.path_loss(freq, dist)
+
+    @classmethod
+    def kernel_logDistance(cls, dist, pt, gt, gr, freq):
+        dist = np.where(dist == 0, 0.1, dist)
+        pl = np.trunc(cls.path_loss(freq, 1))
+        return pt + gt + gr - (pl + np.trunc(10 * ppm.exp * np.log10(dist)))
+
+    @classmethod
+    def kernel_ITU(cls, dist, pt, gt, gr, freq):
+        dist = np.where(dist == 0, 0.1, dist)
+        n = ppm.pL if ppm.pL != 0 else np.where(dist > 16, 38, 28)
+        loss = 20 * np.log10(freq * 10 ** 3) + n * np.log10(dist) \
+            + ppm.lF * ppm.nFloors - 28
+        return pt + gt + gr - np.trunc(loss)
+
+    @classmethod
+    def get_kernel(cls, intf, ap_intf):
+        """:param intf: a station interface of the pass, for the check
+        :param ap_intf: an AP interface of the pass, for the check"""
+        key = cls.model_params()
+        if key not in cls.checked:
+            kernel = getattr(cls, 'kernel_%s' % ppm.model, None)
+            if kernel is not None:
+                dist = np.array([0, 0.5, 1, 12.34, 16, 17, 250])
+                params = cls.get_params([intf], [ap_intf])[0]
+                expected = [intf.get_rssi(ap_intf, d) for d in dist.tolist()]
+                if not np.allclose(kernel(dist, *params), expected):
+                    kernel = None
+            cls.checked[key] = kernel
+        return cls.checked[key]
+
+    @staticmethod
+    def get_params(intfs, ap_intfs):
+        return np.array([(ap_intf.txpower, ap_intf.antennaGain,
+                          intf.antennaGain, intf.freq)
+                         for intf, ap_intf in zip(intfs, ap_intfs)],
+                        dtype=float).reshape(-1, 4)
+
+    @classmethod
+    def rssi(cls, intfs, ap_intfs, dist):
+        """:param intfs: station interfaces
+        :param ap_intfs: AP interfaces, pairwise with intfs
+        :param dist: distance of every pair
+        returns: RSSI of every pair"""
+        dist = np.asarray(dist, dtype=float)
+        if not len(dist):
+            return dist
+        kernel = cls.get_kernel(intfs[0], ap_intfs[0])
+        if kernel is None:
+            return np.array([intf.get_rssi(ap_intf, d) for intf, ap_intf, d
+                             in zip(intfs, ap_intfs, dist.tolist())])
+        params = cls.get_params(intfs, ap_intfs)
+        if cls.use_table:
+            return cls.interpolate(kernel, params, dist)
+        return kernel(dist, *params.T)
+
+    @classmethod
+    def interpolate(cls, kernel, params, dist):
+        "One table lookup per distinct set of pair parameters"
+        rssi = np.empty(len(dist))
+        keys, inverse = np.unique(params, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        for n, key in enumerate(keys):
+            sel = inverse == n
+            distances, values = cls.get_table(kernel, key, dist[sel].max())
+            rssi[sel] = np.interp(dist[sel], distances, values)
+        return rssi
+
+    @classmethod
+    def get_table(cls, kernel, params, max_dist):
+        key = cls.model_params() + tuple(params.tolist())
+        table = cls.tables.get(key)
+        if table is None or table[0][-1] < max_dist:
+            top = max(max_dist, 2 * table[0][-1] if table else 100.0)
+            count = int(math.ceil(top / cls.table_step)) + 1
+            # rounded so that link distances fall exactly on the samples
+            distances = np.round(np.arange(count) * cls.table_step, 6)
+            table = cls.tables[key] = (distances, kernel(distances, *params))
+        return table
+
+
+class PositionHistory(object):
+    """Positions set during a run, kept in preallocated columns (float64
+    time, float32 x/y/z) rather than in one list of tuples per node.
+    Retention policies:
+      all: everything (the columns grow by doubling)
+      ring: the last `seconds` only
+      decimate: one sample per node every `interval` seconds
+      spill: full columns are appended to `filename` and emptied"""
+    policies = ('all', 'ring', 'decimate', 'spill')
+    record = np.dtype([('t', '<f8'), ('node', '<i4'), ('x', '<f4'),
+                       ('y', '<f4'), ('z', '<f4')])  # spill file layout
+
+    def __init__(self, policy='all', seconds=600.0, interval=1.0,
+                 filename=None, capacity=1 << 16):
+        if policy not in self.policies:
+            raise ValueError("Unknown position history policy %s" % policy)
+        if policy == 'spill' and not filename:
+            raise ValueError("The spill policy needs a file name")
+        self.policy = policy
+        self.seconds = seconds
+        self.interval = interval
+        self.filename = filename
+        self.lock = Lock()
+        self.nodes = {}  # node -> index in the node column
+        self.last = []  # per node index, time of its last sample
+        self.size = 0
+        self.spilled = 0  # rows in the spill file
+        self.alloc(capacity)
+        if policy == 'spill':
+            open(filename, 'wb').close()
+
+    def alloc(self, capacity):
+        t, node, xyz = np.empty(capacity), np.empty(capacity, np.int32), \
+            np.empty((capacity, 3), np.float32)
+        if self.size:
+            t[:self.size] = self.t[:self.size]
+            node[:self.size] = self.node[:self.size]
+            xyz[:self.size] = self.xyz[:self.size]
+        self.t, self.node, self.xyz = t, node, xyz
+
+    def append(self, node, pos, t=None):
+        t = time() if t is None else t
+        with self.lock:
+            idx = self.nodes.get(node)
+            if idx is None:
+                idx = self.nodes[node] = len(self.last)
+                self.last.append(-np.inf)
+            if self.policy == 'decimate' and t - self.last[idx] < self.interval:
+                return
+            if self.size == len(self.t):
+                self.make_room(t)
+            row = self.size
+            self.t[row] = t
+            self.node[row] = idx
+            self.xyz[row] = [float(c) for c in pos[:3]] if len(pos) >= 3 else \
+                [float(pos[0]), float(pos[1]), 0.0]
+            self.last[idx] = t
+            self.size += 1
+
+    def make_room(self, t):
+        if self.policy == 'spill':
+            self.spill()
+            return
+        if self.policy == 'ring':
+            # rows are in time order: drop those that left the window
+            keep = int(np.searchsorted(self.t[:self.size], t - self.seconds))
+            if keep:
+                n = self.size - keep
+                self.t[:n] = self.t[keep:self.size]
+                self.node[:n] = self.node[keep:self.size]
+                self.xyz[:n] = self.xyz[keep:self.size]
+                self.size = n
+            if self.size < len(self.t) // 2:
+                return
+        self.alloc(2 * len(self.t))
+
+    def spill(self):
+        rows = np.empty(self.size, self.record)
+        rows['t'] = self.t[:self.size]
+        rows['node'] = self.node[:self.size]
+        for axis, name in enumerate('xyz'):
+            rows[name] = self.xyz[:self.size, axis]
+        with open(self.filename, 'ab') as f:
+            rows.tofile(f)
+        self.spilled += self.size
+        self.size = 0
+
+    def columns(self):
+        "returns: (t, node index, xyz) of every row kept, spilled ones first"
+        with self.lock:
+            first = 0
+            if self.policy == 'ring' and self.size:
+                # rows are only dropped when room is needed
+                first = int(np.searchsorted(self.t[:self.size],
+                                            self.t[self.size - 1] - self.seconds))
+            t = self.t[first:self.size].copy()
+            node = self.node[first:self.size].copy()
+            xyz = self.xyz[first:self.size].copy()
+            spilled = self.spilled
+        if spilled:
+            rows = np.memmap(self.filename, dtype=self.record, mode='r',
+                             shape=(spilled,))
+            t = np.concatenate([rows['t'], t])
+            node = np.concatenate([rows['node'], node])
+            xyz = np.concatenate([np.stack([rows['x'], rows['y'], rows['z']],
+                                           axis=1), xyz])
+        return t, node, xyz
+
+    def get(self, node):
+        "returns: (times, N x 3 positions) of a node"
+        idx = self.nodes.get(node)
+        t, nodes, xyz = self.columns()
+        mask = nodes == (-1 if idx is None else idx)
+        return t[mask], xyz[mask]
+
+    def __len__(self):
+        return self.spilled + self.size
 
 
 class Mobility(object):
@@ -55,8 +1184,124 @@ class Mobility(object):
     mobileNodes = []
     ac = None  # association control method
     pause_simulation = False
+    sim_cond = Condition()  # guards pause_simulation
     allAutoAssociation = True
     thread_ = ''
+    frame = None  # PositionFrame shared by the mobility model thread
+    record_positions = True  # keeps the position history for the trace export
+    history = None  # PositionHistory of the run
+    trace = None  # TraceStreamer of the mob_trace_file
+    model_trace = None  # TraceStreamer of the trace_<model> file
+    dirty = set()  # nodes moved since the last link pass
+    dirty_cond = Condition()  # guards dirty
+    ap_index = None  # APIndex, rebuilt when an AP moves
+    link_plan = None  # LinkPlan, dropped when nodes are added or removed
+    tc_batch = None  # TCBatch of the link pass in progress
+    predictor = None  # HandoverPredictor of the running model, if any
+    use_link_matrix = True
+    use_ap_grid = True  # narrows the link matrix down with the AP grid
+
+    @classmethod
+    def pause(cls):
+        "Pauses the mobility threads"
+        with cls.sim_cond:
+            cls.pause_simulation = True
+
+    @classmethod
+    def resume(cls):
+        "Resumes the mobility threads"
+        with cls.sim_cond:
+            cls.pause_simulation = False
+            cls.sim_cond.notify_all()
+
+    @classmethod
+    def wakeup(cls):
+        "Wakes up every waiting mobility thread, e.g. when stopping"
+        with cls.sim_cond:
+            cls.sim_cond.notify_all()
+        with cls.dirty_cond:
+            cls.dirty_cond.notify_all()
+
+    @staticmethod
+    def close_trace():
+        "Writes the frames still queued for the trace files and closes them"
+        traces = Mobility.trace, Mobility.model_trace
+        Mobility.trace = Mobility.model_trace = None
+        for trace in traces:
+            if trace is not None:
+                trace.close()
+
+    @classmethod
+    def mark_dirty(cls, node):
+        "Queues the node for the next link pass"
+        with cls.dirty_cond:
+            cls.dirty.add(node)
+            cls.dirty_cond.notify()
+
+    @staticmethod
+    def config_link_params(mob_wmediumd_epsilon=0.0, mob_snr_delta=0.0,
+                           mob_snr_interval=0.0, mob_adaptive_links=False,
+                           mob_link_max_interval=1.0, mob_tc_batch=True,
+                           mob_predictive_handover=False, **kwargs):
+        "Sets how often links are evaluated and wmediumd is updated"
+        # what was sent to wmediumd by an earlier run is no baseline
+        WmediumdPositions.reset()
+        WmediumdPositions.epsilon = mob_wmediumd_epsilon
+        SNRUpdates.reset()
+        SNRUpdates.delta = mob_snr_delta
+        SNRUpdates.interval = mob_snr_interval
+        LinkScheduler.enabled = mob_adaptive_links
+        LinkScheduler.max_interval = mob_link_max_interval
+        TCBatch.enabled = mob_tc_batch
+        TCBatch.reset()
+        HandoverPredictor.enabled = mob_predictive_handover
+        HandoverPredictor.refresh = mob_link_max_interval
+
+    @staticmethod
+    def config_history(mob_history='all', mob_history_seconds=600.0,
+                       mob_history_interval=1.0, mob_history_file=None, **kwargs):
+        "Starts the position history of a run; mob_history=None disables it"
+        Mobility.history = PositionHistory(
+            mob_history, seconds=mob_history_seconds,
+            interval=mob_history_interval, filename=mob_history_file) \
+            if mob_history else None
+
+    def wait_dirty(self, timeout=None):
+        """Blocks until some node has moved
+        :param timeout: seconds to wait at most
+        returns: the nodes moved since the previous call"""
+        deadline = None if timeout is None else monotonic() + timeout
+        with self.dirty_cond:
+            while not self.dirty and self.thread_._keep_alive:
+                if deadline is None:
+                    self.dirty_cond.wait()
+                else:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                    self.dirty_cond.wait(remaining)
+            nodes, Mobility.dirty = self.dirty, set()
+        return nodes
+
+    def wait_if_paused(self):
+        """Blocks while the simulation is paused
+        returns: True if the thread had to wait"""
+        with self.sim_cond:
+            if not self.pause_simulation:
+                return False
+            while self.pause_simulation and self.thread_._keep_alive:
+                self.sim_cond.wait()
+        return True
+
+    def wait_until(self, deadline):
+        """Blocks until the deadline is reached or the thread is stopped
+        :param deadline: wall-clock time, as returned by time()"""
+        with self.sim_cond:
+            while self.thread_._keep_alive:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                self.sim_cond.wait(remaining)
 
     def move_factor(self, node, diff_time):
         """:param node: node
@@ -95,15 +1340,11 @@ class Mobility(object):
 
     def set_pos(self, node, pos):
         node.position = pos
-        if not hasattr(node, "positions"):
-            node.positions = []
-        node.positions.append((time(), pos))
-        
-
-        # Record the current time and position.
-        
+        self.mark_dirty(node)
+        if self.record_positions and self.history is not None:
+            self.history.append(node, pos)
         if wmediumd_mode.mode == w_cst.INTERFERENCE_MODE and self.thread_._keep_alive:
-            node.set_pos_wmediumd(pos)
+            WmediumdPositions.update(node, pos)
 
     def set_wifi_params(self):
         "Opens a thread for wifi parameters"
@@ -113,7 +1354,7 @@ class Mobility(object):
             thread_.start()
 
     def remove_staconf(self, intf):
-        sh('rm %s_%s.staconf >/dev/null 2>&1' % (intf.node, intf.id))
+        WpaSupplicants.remove('%s_%s.staconf' % (intf.node, intf.id))
 
     def get_pidfile(self, intf):
         pid = "mn%d_%s_%s_wpa.pid" % (getpid(), intf.node, intf.id)
@@ -121,11 +1362,11 @@ class Mobility(object):
 
     def kill_wpasupprocess(self, intf):
         pid = self.get_pidfile(intf)
-        sh('pkill -f \'wpa_supplicant -B -Dnl80211 -P %s -i %s\'' % (pid, intf.name))
+        WpaSupplicants.kill(pid, intf.name)
 
     def check_if_wpafile_exist(self, intf):
         file = '%s_%s.staconf' % (intf.name, intf.id)
-        if glob(file):
+        if os.path.exists(file):
             self.remove_staconf(intf)
 
     @staticmethod
@@ -142,52 +1383,66 @@ class Mobility(object):
                     self.kill_wpasupprocess(intf)
                     self.check_if_wpafile_exist(intf)
             elif wmediumd_mode.mode == w_cst.SNR_MODE:
-                intf.setSNRWmediumd(ap_intf, -10)
+                SNRUpdates.update(intf, ap_intf, -10, out_of_range=True)
             if not ap_intf.ieee80211r:
                 intf.disconnect(ap_intf)
             self.remove_node_in_range(intf, ap_intf)
         elif not intf.associatedTo:
             intf.rssi = 0
 
-    def ap_in_range(self, intf, ap, dist):
-        for ap_intf in ap.wintfs.values():
-            if isinstance(ap_intf, master):
+    def ap_in_range(self, intf, ap, dist, rssis=None):
+        """:param rssis: dict ap_intf -> rssi, if already known"""
+        for ap_intf in self.get_link_plan().masters(ap):
+            rssi = rssis.get(ap_intf) if rssis else None
+            if rssi is None:
                 rssi = intf.get_rssi(ap_intf, dist)
-                intf.apsInRange[ap_intf.node] = rssi
-                ap_intf.stationsInRange[intf.node] = rssi
-                if ap_intf == intf.associatedTo:
-                    if intf not in ap_intf.associatedStations:
-                        ap_intf.associatedStations.append(intf)
-                    if dist >= 0.01:
-                        if intf.bgscan_module or (intf.active_scan
-                                                  and intf.encrypt == 'wpa'):
-                            pass
+            intf.apsInRange[ap_intf.node] = rssi
+            ap_intf.stationsInRange[intf.node] = rssi
+            if ap_intf == intf.associatedTo:
+                if intf not in ap_intf.associatedStations:
+                    ap_intf.associatedStations.append(intf)
+                if dist >= 0.01:
+                    if intf.bgscan_module or (intf.active_scan
+                                              and intf.encrypt == 'wpa'):
+                        pass
+                    else:
+                        intf.rssi = rssi
+                        # send rssi to hwsim
+                        if hasattr(intf.node, 'phyid'):
+                            intf.rec_rssi()
+                        if wmediumd_mode.mode != w_cst.WRONG_MODE:
+                            if wmediumd_mode.mode == w_cst.SNR_MODE:
+                                SNRUpdates.update(intf, ap_intf, intf.rssi-(-91))
                         else:
-                            intf.rssi = rssi
-                            # send rssi to hwsim
-                            if hasattr(intf.node, 'phyid'):
-                                intf.rec_rssi()
-                            if wmediumd_mode.mode != w_cst.WRONG_MODE:
-                                if wmediumd_mode.mode == w_cst.SNR_MODE:
-                                    intf.setSNRWmediumd(ap_intf, intf.rssi-(-91))
-                            else:
-                                if hasattr(intf.node, 'pos') and intf.node.position != intf.node.pos:
-                                    intf.node.pos = intf.node.position
-                                    intf.configWLink(dist)
-
-    def check_in_range(self, intf, ap_intf):
-        dist = intf.node.get_distance_to(ap_intf.node)
+                            if hasattr(intf.node, 'pos') and intf.node.position != intf.node.pos:
+                                intf.node.pos = intf.node.position
+                                self.config_wlink(intf, dist)
+
+    def config_wlink(self, intf, dist):
+        "Shapes the link, batched with the rest of the pass if possible"
+        if self.tc_batch is None:
+            intf.configWLink(dist)
+        else:
+            self.tc_batch.record(intf.node, intf.configWLink, dist)
+
+    def check_in_range(self, intf, ap_intf, dist=None):
+        if dist is None:
+            dist = intf.node.get_distance_to(ap_intf.node)
         if dist > ap_intf.range:
             self.ap_out_of_range(intf, ap_intf)
             return 0
         return 1
 
-    def set_handover(self, intf, aps):
+    def set_handover(self, intf, aps, dists=None, rssis=None):
+        """:param aps: APs in range
+        :param dists: dict ap -> distance, if already known
+        :param rssis: dict ap_intf -> rssi, if already known"""
+        plan = self.get_link_plan()
         for ap in aps:
-            dist = intf.node.get_distance_to(ap)
-            for ap_wlan, ap_intf in enumerate(ap.wintfs.values()):
+            dist = dists[ap] if dists else intf.node.get_distance_to(ap)
+            for ap_intf in plan.get_ap(ap)[0]:
                 self.do_handover(intf, ap_intf)
-            self.ap_in_range(intf, ap, dist)
+            self.ap_in_range(intf, ap, dist, rssis)
 
     @staticmethod
     def check_if_ap_exists(intf, ap_intf):
@@ -206,22 +1461,160 @@ class Mobility(object):
                 if ap_intf.node != intf.associatedTo:
                     intf.associate_infra(ap_intf)
 
+    def stations_near(self, ap):
+        "Stations an AP may have to (dis)connect after it moves"
+        intfs = list(ap.wintfs.values())
+        ap_range = max([intf.range for intf in intfs] or [0])
+        stations = set()
+        for intf in intfs:
+            stations.update(getattr(intf, 'stationsInRange', {}))
+        for sta in self.stations:
+            if sta not in stations and sta.get_distance_to(ap) <= ap_range:
+                stations.add(sta)
+        return stations
+
+    def get_dirty_stations(self, nodes, mob_nodes):
+        aps = set(self.aps)
+        stations = set()
+        for node in nodes:
+            if node in aps:
+                stations.update(self.stations_near(node))
+            elif node in mob_nodes:
+                stations.add(node)
+        return stations
+
     def parameters(self):
         "Applies channel params and handover"
-        mob_nodes = list(set(self.mobileNodes) - set(self.aps))
+        mob_nodes = set(self.mobileNodes) - set(self.aps)
+        # the first pass covers every node, then only those that moved
+        with self.dirty_cond:
+            self.dirty.update(mob_nodes)
+        scheduler = None
         while self.thread_._keep_alive:
-            self.config_links(mob_nodes)
+            # predictions replace the scheduler once the model publishes them
+            predictor = self.predictor if self.use_link_matrix else None
+            if scheduler is None and LinkScheduler.enabled and self.use_link_matrix:
+                scheduler = LinkScheduler()
+            planner = predictor or scheduler
+            nodes = self.wait_dirty(planner.timeout() if planner else None)
+            stations = self.get_dirty_stations(nodes, mob_nodes)
+            positions = None
+            if planner:
+                if nodes & set(self.aps):
+                    planner.expire()
+                if predictor:
+                    stations, positions = predictor.select(stations)
+                else:
+                    stations = scheduler.select(stations)
+            if not stations:
+                continue
+            if MobilityStats.enabled:
+                start = perf_counter()
+                links = self.config_links(stations, positions)
+                MobilityStats.link_pass(start)
+            else:
+                links = self.config_links(stations, positions)
+            if planner:
+                planner.schedule(links)
 
-    def associate_interference_mode(self, intf, ap_intf):
+    def associate_interference_mode(self, intf, ap_intf, dist=None):
         if intf.bgscan_module or (intf.active_scan and 'wpa' in intf.encrypt):
             if not intf.associatedTo:
                 intf.associate_infra(ap_intf)
                 intf.associatedTo = 'bgscan' if intf.bgscan_module else 'active_scan'
             return 0
 
-        return self.check_in_range(intf, ap_intf)
+        return self.check_in_range(intf, ap_intf, dist)
+
+    @classmethod
+    def invalidate_link_plan(cls):
+        "Nodes or interfaces were added or removed"
+        cls.link_plan = None
+
+    def get_link_plan(self):
+        plan = Mobility.link_plan
+        if plan is None:
+            plan = Mobility.link_plan = LinkPlan()
+        return plan
 
-    def config_links(self, nodes):
+    def get_ap_index(self, plan):
+        index = Mobility.ap_index
+        if index is None or not index.is_valid(self.aps, plan, self.use_ap_grid):
+            index = Mobility.ap_index = APIndex(self.aps, plan, self.use_ap_grid)
+        return index
+
+    @staticmethod
+    def is_scanning(intf):
+        "Scanning stations associate on their own, whatever the distance"
+        return wmediumd_mode.mode == w_cst.INTERFERENCE_MODE and (
+            intf.bgscan_module or (intf.active_scan and 'wpa' in intf.encrypt))
+
+    def get_pass_rssi(self, plan, links, nodes):
+        """RSSI of every station interface towards the APs in range
+        returns: dict intf -> dict ap_intf -> rssi"""
+        intfs, ap_intfs, dists = [], [], []
+        for node in nodes:
+            aps = links.aps_in_range(node)
+            for intf in plan.station_intfs(node):
+                if self.is_scanning(intf):
+                    continue
+                for ap, dist in aps.items():
+                    for ap_intf in plan.masters(ap):
+                        intfs.append(intf)
+                        ap_intfs.append(ap_intf)
+                        dists.append(dist)
+        rssis = {}
+        rssi = RSSIKernels.rssi(intfs, ap_intfs, dists).tolist()
+        for intf, ap_intf, value in zip(intfs, ap_intfs, rssi):
+            rssis.setdefault(intf, {})[ap_intf] = value
+        return rssis
+
+    def config_intf_links(self, intf, links, rssis=None):
+        "Applies the link matrix row of the station to one of its interfaces"
+        index = links.index
+        if self.is_scanning(intf):
+            dist = links.distances(intf.node)
+            for ap_intf in index.intfs:
+                self.associate_interference_mode(
+                    intf, ap_intf, dist[index.intf_aps[index.columns[ap_intf]]])
+            return
+        # ap_out_of_range only acts on the associated AP, or resets the
+        # rssi of a station associated with none, in AP order
+        cols = links.in_range_cols(intf.node)
+        col = index.columns.get(intf.associatedTo)
+        if col is not None and col not in cols:
+            self.ap_out_of_range(intf, intf.associatedTo)
+            if not intf.associatedTo and \
+                    sum(1 for c in cols if c > col) < len(index.intfs) - col - 1:
+                intf.rssi = 0
+        elif not intf.associatedTo and len(cols) < len(index.intfs):
+            intf.rssi = 0
+        aps = links.aps_in_range(intf.node)
+        self.set_handover(intf, list(aps), aps, rssis)
+
+    def config_links(self, nodes, positions=None):
+        """Link pass over the stations in nodes
+        :param positions: dict station -> position, overriding the
+        frame position of predicted stations
+        returns: the LinkMatrix of the pass, None with the full scan"""
+        self.tc_batch = TCBatch() if TCBatch.enabled else None
+        try:
+            return self.config_links_pass(nodes, positions)
+        finally:
+            if self.tc_batch is not None:
+                self.tc_batch.flush()
+                self.tc_batch = None
+
+    def config_links_pass(self, nodes, positions=None):
+        if self.use_link_matrix:
+            plan = self.get_link_plan()
+            stations = [node for node in nodes if hasattr(node, 'position')]
+            links = LinkMatrix(stations, self.get_ap_index(plan), positions)
+            rssis = self.get_pass_rssi(plan, links, stations)
+            for node in stations:
+                for intf in plan.station_intfs(node):
+                    self.config_intf_links(intf, links, rssis.get(intf))
+            return links
         for node in nodes:
             for intf in node.wintfs.values():
                 if isinstance(intf, adhoc) or isinstance(intf, mesh) or isinstance(intf, ITSLink):
@@ -238,7 +1631,6 @@ class Mobility(object):
                                 if ack and ap not in aps:
                                     aps.append(ap)
                     self.set_handover(intf, aps)
-        sleep(0.0001)
 
 
 class ConfigMobility(Mobility):
@@ -282,13 +1674,281 @@ class ConfigMobLinks(Mobility):
         self.config_links(nodes)
 
 
+class PositionFrame(object):
+    "Shared (N, 3) position array written once per mobility tick"
+
+    def __init__(self, nodes, positions=None):
+        """:param nodes: list of nodes, in the same order as the rows
+        yielded by the mobility generator
+        :param positions: current positions; nodes are then only reported
+        by commit once they move away from them"""
+        self.nodes = nodes
+        self.array = np.zeros((len(nodes), 3))
+        self.valid = positions is not None
+        if self.valid and nodes:
+            self.array[:] = [[float(c) for c in pos] for pos in positions]
+        for idx, node in enumerate(nodes):
+            # a view, not a copy: it always reflects the last committed frame
+            node.frame_pos = self.array[idx]
+
+    def commit(self, xy):
+        """Writes a whole frame into the shared array
+        :param xy: (N, 2) or (N, 3) array-like yielded by the generator
+        returns: list of (node, pos) for the nodes that actually moved"""
+        xy = np.asarray(xy, dtype=float)
+        dims = min(xy.shape[1], 3)
+        xy = np.round(xy[:, :dims], 2)
+        if self.valid:
+            moved = np.flatnonzero(np.any(xy != self.array[:, :dims], axis=1))
+        else:
+            moved = np.arange(len(self.nodes))
+            self.valid = True
+        self.array[moved, :dims] = xy[moved]
+        rows = self.array[moved].tolist()
+        return [(self.nodes[idx], tuple(pos)) for idx, pos in zip(moved.tolist(), rows)]
+
+
+class FramePrefetcher(object):
+    """Runs a mobility generator ahead of the commit loop, in its own
+    thread, into a bounded ring of preallocated frames. The generator is
+    still stepped in order by a single thread, so frames are unchanged"""
+
+    def __init__(self, mob, nr_nodes, depth=4):
+        """:param mob: mobility generator
+        :param nr_nodes: number of rows per frame
+        :param depth: number of frames the generator may run ahead"""
+        self.mob = mob
+        self.depth = depth
+        self.frames = np.zeros((depth, nr_nodes, 3))
+        self.produced = 0
+        self.consumed = 0
+        self.done = False
+        self.error = None
+        self.cond = Condition()
+        self.owner = Mobility.thread_  # the commit loop thread
+        self.thread_ = thread(name='mobPrefetch', target=self.produce)
+        self.thread_.daemon = True
+        self.thread_.start()
+
+    def produce(self):
+        try:
+            for xy in self.mob:
+                with self.cond:
+                    while self.produced - self.consumed >= self.depth \
+                            and not self.done:
+                        self.cond.wait()
+                    if self.done or not getattr(self.owner, '_keep_alive',
+                                                    True):
+                        break
+                # the commit loop never holds this slot, see __iter__
+                slot = self.frames[self.produced % self.depth]
+                xy = np.asarray(xy, dtype=float)
+                dims = min(xy.shape[1], 3)
+                slot[:, :dims] = xy[:, :dims]
+                slot[:, dims:] = 0
+                with self.cond:
+                    self.produced += 1
+                    self.cond.notify_all()
+        except Exception as e:
+            self.error = e
+        with self.cond:
+            self.done = True
+            self.cond.notify_all()
+
+    def __iter__(self):
+        stats = MobilityStats
+        holding = False
+        while True:
+            with self.cond:
+                if holding:
+                    # the previous frame has been committed: release its slot
+                    self.consumed += 1
+                    self.cond.notify_all()
+                start = perf_counter()
+                while self.produced <= self.consumed and not self.done:
+                    self.cond.wait()
+                if self.produced <= self.consumed:
+                    break
+                ahead = self.produced - self.consumed
+            if stats.enabled:
+                stats.lap('prefetch_wait', start)
+                stats.gauge('prefetch_depth', ahead)
+            holding = True
+            yield self.frames[self.consumed % self.depth]
+        if self.error:
+            raise self.error
+
+    def stop(self):
+        with self.cond:
+            self.done = True
+            self.cond.notify_all()
+
+
+class TrajectoryCache(object):
+    """On-disk cache of generated frames, keyed by a hash of everything
+    that determines them. Entries are .npy files memory-mapped on replay;
+    the least recently used ones are evicted once the directory grows
+    above max_size bytes"""
+    max_size = 1 << 30
+    version = 1
+
+    def __init__(self, directory, max_size=max_size):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def key(cls, **params):
+        params['version'] = cls.version
+        data = json.dumps(params, sort_keys=True, default=repr)
+        return hashlib.sha1(data.encode()).hexdigest()
+
+    @staticmethod
+    def file_digest(filename):
+        if not os.path.isfile(filename):
+            return None
+        with open(filename, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def load(self, key):
+        "returns: read-only (frames, nodes, 2) array, or None on a miss"
+        filename = self.filename(key)
+        try:
+            frames = np.load(filename, mmap_mode='r')
+        except (IOError, ValueError):
+            return None
+        os.utime(filename)  # most recently used
+        return frames
+
+    def store(self, key, frames):
+        filename = self.filename(key)
+        tmp = '%s.%d.tmp' % (filename, getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, frames)
+        os.replace(tmp, filename)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for filename in glob(os.path.join(self.directory, '*.npy')):
+            stat = os.stat(filename)
+            entries.append((stat.st_mtime, stat.st_size, filename))
+        entries.sort()
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, filename in entries[:-1]:
+            if size <= self.max_size:
+                break
+            os.remove(filename)
+            size -= entry_size
+
+    def record(self, key, mob, nr_frames, nr_nodes, frames=None):
+        """Passes the frames through, storing the entry again every
+        nr_frames frames, for as long as it fits in max_size
+        :param frames: frames already stored, which the new ones follow"""
+        if frames is None:
+            frames = np.zeros((0, nr_nodes, 2), dtype=np.float32)
+        pending = []
+        for xy in mob:
+            if pending is not None:
+                # rounded as in PositionFrame, so that float32 keeps them exact
+                pending.append(np.round(np.asarray(xy, dtype=float)[:, :2], 2))
+                if len(pending) == nr_frames:
+                    frames = np.concatenate(
+                        [frames, np.array(pending, dtype=np.float32)])
+                    self.store(key, frames)
+                    fits = frames.nbytes + frames[:nr_frames].nbytes <= self.max_size
+                    pending = [] if fits else None
+            yield xy
+
+    def replay(self, key, frames, factory):
+        """Yields the cached frames, then the following ones from a new
+        generator built by factory, which are added to the entry so that
+        the next replay goes on further. Generators cannot be saved: the
+        new one is only built once the run gets past the cached frames,
+        and has to step through them again first, during which the loop
+        waits"""
+        for frame in frames:
+            yield frame
+        owner = Mobility.thread_
+        mob = factory()
+        for _ in islice(mob, len(frames)):
+            if not getattr(owner, '_keep_alive', True):
+                return
+        for xy in self.record(key, mob, len(frames), frames.shape[1], frames):
+            yield xy
+
+
+class SimulationClock(object):
+    """Model time shared by the mobility generators and the commit loop.
+    Every frame advances the model time by timestep; rt_factor maps model
+    time to wall-clock time (1: real time, 10: ten times faster,
+    0/None/inf: as fast as possible)"""
+
+    def __init__(self, timestep=0.1, rt_factor=1.0):
+        if timestep <= 0:
+            raise ValueError("The simulation timestep must be greater than 0")
+        self.timestep = float(timestep)
+        self.rt_factor = rt_factor
+        self.frames = 0
+        self.origin = None  # (wall time, frame) the schedule is anchored to
+
+    @property
+    def now(self):
+        "Model time of the current frame"
+        return self.frame_time(self.frames)
+
+    def frame_time(self, frame):
+        # multiplying instead of accumulating keeps the model time drift-free
+        return frame * self.timestep
+
+    def realtime(self):
+        return bool(self.rt_factor) and self.rt_factor != float('inf')
+
+    def start(self):
+        "(Re)anchors the schedule to the current wall-clock time"
+        self.origin = (monotonic(), self.frames)
+
+    def advance(self):
+        "Moves to the next frame"
+        if self.origin is None:
+            self.start()
+        self.frames += 1
+
+    def delay(self):
+        """Wall-clock seconds until the current frame is due.
+        Negative values mean the loop is running late"""
+        if not self.realtime():
+            return 0
+        wall, frame = self.origin
+        model_time = self.frame_time(self.frames - frame)
+        return wall + model_time / self.rt_factor - monotonic()
+
+
 class model(Mobility):
+    mob_models = ['RandomWalk', 'TruncatedLevyWalk', 'RandomDirection', 'Pursue',
+                  'ManhattanGridMobility', 'TIMMMobility', 'SWIMMobility',
+                  'RandomWayPoint', 'GaussMarkov', 'ReferencePoint',
+                  'TimeVariantCommunity', 'CRP']
+    # models stepping a fixed distance per frame rather than following the
+    # clock: their frames keep the 0.5 s they always lasted, whatever
+    # mob_timestep is, so that nodes move at the same speed as before
+    untimed_models = ['RandomWalk', 'TruncatedLevyWalk', 'RandomDirection',
+                      'RandomWayPoint', 'GaussMarkov', 'ReferencePoint',
+                      'TimeVariantCommunity', 'CRP']
+    untimed_timestep = 0.5
+    max_frames = 0  # 0 runs the model until the thread is stopped
+    frame_sinks = []  # callables receiving (model time, frame array)
 
     def __init__(self, **kwargs):
         self.start_thread(**kwargs)
 
     def start_thread(self, **kwargs):
         debug('Starting mobility thread...\n')
+        self.config_link_params(**kwargs)
+        self.config_history(**kwargs)
         Mobility.thread_ = thread(name='mobModel', target=self.models, kwargs=kwargs)
         Mobility.thread_.daemon = True
         Mobility.thread_._keep_alive = True
@@ -303,6 +1963,10 @@ class model(Mobility):
         "Used when a mobility model is set"
         np.random.seed(seed)
         self.ac = kwargs.get('ac_method', None)
+        kwargs['mob_timestep'] = self.frame_length(
+            mob_model, kwargs.get('mob_timestep', 0.1))
+        self.clock = self.create_clock(**kwargs)
+        self.prefetch = kwargs.get('mob_prefetch', 0)
         n_groups = kwargs.get('n_groups', 1)
         self.stations, self.mobileNodes, self.aps = stations, stations, aps
 
@@ -350,7 +2014,39 @@ class model(Mobility):
                 PlotGraph.pause()
             return
 
+        mob_args = dict(mob_model=mob_model, mob_nodes=mob_nodes, seed=seed,
+                        n_groups=n_groups, min_wt=min_wt, max_wt=max_wt,
+                        max_x=max_x, max_y=max_y, **kwargs)
+        if kwargs.get('mob_cache'):
+            mob = self.cached_model(model_args, mob_args)
+        else:
+            mob = self.create_model(model_args=dict(model_args), **mob_args)
+        segment_model = self.segment_model
+        Mobility.predictor = None
+        if HandoverPredictor.enabled and self.use_link_matrix and self.clock.realtime():
+            # cached and prefetched frames are not those of the model object
+            if segment_model and not kwargs.get('mob_cache') and not self.prefetch:
+                Mobility.predictor = HandoverPredictor(self.clock)
+            else:
+                debug('No segments from %s, links are evaluated per frame\n' % mob_model)
+
+        if kwargs.get('mob_trace_file'):
+            self.close_trace()
+            Mobility.trace = TraceStreamer(frame_writer(
+                kwargs['mob_trace_file'], mob_nodes, self.clock.timestep,
+                kwargs.get('mob_trace_format')))
+            self.frame_sinks = self.frame_sinks + [self.trace]
+
+        self.wait_until(time() + kwargs['mob_start_time'])
+
+        self.start_mob_mod(mob, mob_nodes, draw)
+
+    def create_model(self, mob_model, mob_nodes, model_args, seed, n_groups,
+                     min_wt, max_wt, max_x, max_y, **kwargs):
+        "Returns the generator of the mobility model"
+        np.random.seed(seed)
         debug('Configuring the mobility model %s\n' % mob_model)
+        self.segment_model = None  # model object exposing segments()
         if mob_model == 'RandomWalk':  # Random Walk model
             for node in mob_nodes:
                 array_ = ['constantVelocity', 'constantDistance']
@@ -376,7 +2072,8 @@ class model(Mobility):
             allowed_keys = ['x', 'y', 'minspeed', 'maxspeed', 'aggressiveness', 'pursueRandomnessMagnitude', 'random_seed']
             # Filter model_args so that only allowed keys remain
             filtered_args = { key: model_args.get(key) for key in allowed_keys }
-            mob = pursue(mob_nodes, **filtered_args)
+            self.segment_model = Pursue(mob_nodes, clock=self.clock, **filtered_args)
+            mob = iter(self.segment_model)
 
         elif mob_model == 'ManhattanGridMobility':
             # Set defaults into model_args if not already provided
@@ -399,7 +2096,10 @@ class model(Mobility):
                 'pauseProb', 'maxPause', 'randomSeed'
             ]
             filtered_args = { key: model_args.get(key) for key in allowed_keys }
-            mob = manhattanGridMobility(mob_nodes, **filtered_args)
+            self.segment_model = ManhattanGridMobility(
+                mob_nodes, clock=self.clock, trace=self.create_model_trace(
+                    'manhattan', range(len(mob_nodes)), **kwargs), **filtered_args)
+            mob = iter(self.segment_model)
 
         elif mob_model == 'TIMMMobility':
             model_args.setdefault('x', max_x)
@@ -421,7 +2121,10 @@ class model(Mobility):
                 'Door_wait_or_opening_time', 'Slow_speed', 'Fast_speed', 'randomSeed'
             ]
             filtered_args = { key: model_args.get(key) for key in allowed_keys }        
-            mob = tIMMMobility(mob_nodes, **filtered_args)
+            self.segment_model = TIMMMobility(
+                mob_nodes, clock=self.clock, trace=self.create_model_trace(
+                    'TIMM', range(1, len(mob_nodes) + 1), **kwargs), **filtered_args)
+            mob = iter(self.segment_model)
 
         elif mob_model == 'SWIMMobility':
             model_args.setdefault('x', max_x)
@@ -437,10 +2140,10 @@ class model(Mobility):
                 'waitingTimeExponent', 'waitingTimeUpperBound', 'randomSeed'
             ]
             filtered_args = { key: model_args.get(key) for key in allowed_keys }
-            mob = swimMobility(mob_nodes, **filtered_args)
+            mob = swimMobility(mob_nodes, clock=self.clock, trace=self.create_model_trace(
+                'SWIM', range(len(mob_nodes)), **kwargs), **filtered_args)
 
 
- 
         elif mob_model == 'RandomWayPoint':  # Random Waypoint model
             for node in mob_nodes:
                 array_ = ['constantVelocity', 'constantDistance',
@@ -479,68 +2182,252 @@ class model(Mobility):
                                       aggregation=aggregation)
         else:
             raise Exception("Mobility Model not defined or doesn't exist!")
+        return mob
+
+    def cached_model(self, model_args, mob_args):
+        """Replays the frames from the trajectory cache when they are
+        there, records them otherwise. The model itself is only built on
+        a miss, or to go on past the cached frames"""
+        nodes = mob_args['mob_nodes']
+        cache = TrajectoryCache(mob_args['mob_cache'],
+                                mob_args.get('mob_cache_size', TrajectoryCache.max_size))
+        nr_frames = int(round(mob_args.get('mob_cache_duration', 600) /
+                              self.clock.timestep))
+        node_args = ['min_x', 'max_x', 'min_y', 'max_y', 'min_v', 'max_v',
+                     'constantVelocity', 'constantDistance']
+        graph = model_args.get('building_graph', 'building_graph.txt')
+        key = cache.key(model=mob_args['mob_model'], args=model_args,
+                        nodes=[[getattr(node, arg, None) for arg in node_args]
+                               for node in nodes],
+                        seed=mob_args['seed'], n_groups=mob_args['n_groups'],
+                        min_wt=mob_args['min_wt'], max_wt=mob_args['max_wt'],
+                        max_x=mob_args['max_x'], max_y=mob_args['max_y'],
+                        timestep=self.clock.timestep, frames=nr_frames,
+                        graph=cache.file_digest(graph)
+                        if mob_args['mob_model'] == 'TIMMMobility' else None)
+        factory = lambda: self.create_model(model_args=dict(model_args), **mob_args)
+        frames = cache.load(key)
+        if frames is None:
+            debug('Trajectory cache miss, recording %d frames\n' % nr_frames)
+            return cache.record(key, factory(), nr_frames, len(nodes))
+        debug('Replaying %d frames from the trajectory cache\n' % len(frames))
+        self.segment_model = None
+        return cache.replay(key, frames, factory)
+
+    def create_model_trace(self, name, ids, mob_model_trace=None, **kwargs):
+        """Sink of the trace_<name> file some models write
+        :param ids: node_id column
+        :param mob_model_trace: None, 'csv' or 'binary'"""
+        if Mobility.model_trace is not None:
+            Mobility.model_trace.close()
+            Mobility.model_trace = None
+        if not mob_model_trace or mob_model_trace == 'none':
+            return None
+        if mob_model_trace == 'binary':
+            writer = BinaryFrameWriter('trace_%s%s' % (name, BinaryTrace.extension),
+                                       ['%d' % i for i in ids], self.clock.timestep)
+        else:
+            writer = CSVFrameWriter('trace_%s.csv' % name, ids, layout='model', ids=ids)
+        Mobility.model_trace = TraceStreamer(writer)
+        return Mobility.model_trace
 
-        current_time = time()
-        while (time() - current_time) < kwargs['mob_start_time']:
-            pass
+    @classmethod
+    def frame_length(cls, mob_model, mob_timestep=0.1):
+        "Model seconds per frame of mob_model"
+        if mob_model in cls.untimed_models:
+            return cls.untimed_timestep
+        return mob_timestep
 
-        self.start_mob_mod(mob, mob_nodes, draw)
+    @staticmethod
+    def create_clock(mob_timestep=0.1, mob_rt_factor=1.0, **kwargs):
+        return SimulationClock(timestep=mob_timestep, rt_factor=mob_rt_factor)
 
     def start_mob_mod(self, mob, nodes, draw):
         """
         :param mob: mobility params
         :param nodes: list of nodes
         """
+        if not self.prefetch:
+            return self.run_mob_mod(mob, nodes, draw)
+        prefetcher = FramePrefetcher(mob, len(nodes), depth=self.prefetch)
+        try:
+            self.run_mob_mod(prefetcher, nodes, draw)
+        finally:
+            prefetcher.stop()
+
+    def commit_frame(self, xy, draw):
+        "Applies one generator frame; only nodes that moved are touched"
+        WmediumdPositions.begin()
+        for node, pos in self.frame.commit(xy):
+            self.set_pos(node, pos)
+            if draw:
+                node.update_2d()
+        WmediumdPositions.flush()
+
+    def run_mob_mod(self, mob, nodes, draw):
+        stats = MobilityStats
+        Mobility.frame = PositionFrame(nodes)
+        self.clock.start()
+        tick = perf_counter()
         for xy in mob:
-            for idx, node in enumerate(nodes):
-                pos = round(xy[idx][0], 2), round(xy[idx][1], 2), 0.0
-                self.set_pos(node, pos)
-                if draw:
-                    node.update_2d()
+            # wait_until and wait_if_paused return at once after a stop
+            if not self.thread_._keep_alive:
+                break
+            timed = stats.enabled
+            if timed:
+                now = stats.lap('step', tick)
+            self.commit_frame(xy, draw)
+            if self.predictor:
+                for node in self.predictor.publish(nodes, self.segment_model.segments(),
+                                                   self.clock.now):
+                    self.mark_dirty(node)
+            for sink in self.frame_sinks:
+                sink(self.clock.now, self.frame.array)
+            if timed:
+                now = stats.lap('commit', now)
             if draw:
                 PlotGraph.pause()
+                if timed:
+                    stats.lap('plot', now)
+            self.clock.advance()
+            if self.max_frames and self.clock.frames >= self.max_frames:
+                break
+            if self.wait_if_paused():
+                # the time spent paused must not be caught up afterwards
+                self.clock.start()
             else:
-                sleep(0.5)
-            while self.pause_simulation:
-                pass
+                delay = self.clock.delay()
+                if timed and self.clock.realtime():
+                    stats.record('lateness', max(-delay, 0))
+                self.wait_until(time() + delay)
+            tick = perf_counter()
 
 
 class TimedModel(model):
     def __init__(self, **kwargs):
-        # In order to use nanosecond resolution with the monotonic clock, 
-        # we need to convert to nanoseconds
-        self.tick_time = kwargs.get('timed_model_mob_tick', 1) * 1e9
+        # wall-clock seconds between two mobility ticks
+        self.tick_time = kwargs.get('timed_model_mob_tick', 1)
         super().__init__(**kwargs)
 
-    def start_mob_mod(self, mob, nodes, draw):
-        """
-        :param mob: mobility params
-        :param nodes: list of nodes
-        """
-        next_tick_time = monotonic_ns() + self.tick_time
-        for xy in mob:
-            for idx, node in enumerate(nodes):
-                pos = round(xy[idx][0], 2), round(xy[idx][1], 2), 0.0
-                self.set_pos(node, pos)
-                if draw:
-                    node.update_2d()
-            if draw:
-                PlotGraph.pause()
-            if self.pause_simulation:
-                while self.pause_simulation:
-                    pass
-                # When resuming simulation, reset the tick timing
-                next_tick_time = monotonic_ns() + self.tick_time
-                continue
-            # We try to use "best effort" scheduling- we want to have
-            # done as many ticks as there are elapsed seconds since we last
-            # performed a mobility tick and try to iterate the loop as consistently
-            # as possible
-            else:
-                while monotonic_ns() < next_tick_time:
-                    # If time() has been exceeded since the while loop check, don't sleep
-                    sleep(max((next_tick_time - monotonic_ns()) / 1e9, 0))
-            next_tick_time = next_tick_time + self.tick_time
+    def create_clock(self, mob_timestep=0.1, **kwargs):
+        # one frame per tick_time, whatever the model timestep is
+        return SimulationClock(timestep=mob_timestep,
+                               rt_factor=mob_timestep / self.tick_time)
+
+
+class HeadlessNode(object):
+    "Lightweight stand-in for a station: just what the models read"
+
+    def __init__(self, name, **params):
+        self.name = name
+        self.params = params
+        self.position = (0, 0, 0)
+        self.wintfs = {}
+
+    def update_2d(self):
+        pass
+
+    def get_distance_to(self, dst):
+        x = (float(self.position[0]) - float(dst.position[0])) ** 2
+        y = (float(self.position[1]) - float(dst.position[1])) ** 2
+        z = (float(self.position[2]) - float(dst.position[2])) ** 2
+        return round(math.sqrt(x + y + z), 2)
+
+    def __str__(self):
+        return self.name
+
+
+class HeadlessModel(model):
+    """Drives a mobility model without Mininet-WiFi, as fast as possible.
+    Frames go through the same models/start_mob_mod path used in emulation"""
+    record_positions = False  # frames are streamed to the sinks instead
+
+    def __init__(self, duration, mob_timestep=0.1, **kwargs):
+        """:param duration: model time to generate (seconds)
+        :param mob_timestep: model seconds per frame"""
+        self.duration = duration
+        self.frame_sinks = []
+        self.kwargs = kwargs
+        self.kwargs.setdefault('mob_cache_duration', duration)
+        self.kwargs.update(mob_timestep=mob_timestep, mob_rt_factor=0)
+
+    def create_clock(self, **kwargs):
+        # untimed models do not use mob_timestep
+        clock = model.create_clock(**kwargs)
+        self.max_frames = max(int(round(self.duration / clock.timestep)), 1)
+        return clock
+
+    def run(self, nodes):
+        """:param nodes: list of HeadlessNode"""
+        Mobility.thread_ = current_thread()
+        Mobility.thread_._keep_alive = True
+        self.config_link_params(**self.kwargs)
+        self.kwargs.setdefault('mob_start_time', 0)
+        self.models(stations=nodes, aps=[], stat_nodes=[], mob_nodes=nodes,
+                    draw=False, **self.kwargs)
+
+
+def generate_trace(mob_model, nodes, duration, filename, **kwargs):
+    """Generates a mobility trace offline
+    :param mob_model: any model accepted by model.models
+    :param nodes: number of nodes or list of HeadlessNode
+    :param duration: model time to generate (seconds)
+    :param filename: output trace file; a BinaryTrace if it ends in
+    .mntrace or mob_trace_format='binary' is given
+    returns: number of frames written"""
+    if isinstance(nodes, int):
+        nodes = [HeadlessNode('sta%d' % (n + 1)) for n in range(nodes)]
+    runner = HeadlessModel(duration, mob_model=mob_model, **kwargs)
+    timestep = model.frame_length(mob_model, kwargs.get('mob_timestep', 0.1))
+    writer = TraceStreamer(frame_writer(filename, nodes, timestep,
+                                        kwargs.get('mob_trace_format')))
+    runner.frame_sinks.append(writer)
+    try:
+        runner.run(nodes)
+    finally:
+        writer.close()
+        Mobility.close_trace()
+    return runner.clock.frames
+
+
+class TrackedPaths(object):
+    """Tracked paths compiled into flat NumPy arrays, so that the position
+    of every node at any time comes from one vectorized interpolation"""
+
+    def __init__(self, paths, starts, dt=0.1):
+        """:param paths: one (L, 3) sequence of positions per node
+        :param starts: time at which each node leaves its first position
+        :param dt: time between two consecutive positions"""
+        lengths = np.array([len(path) for path in paths])
+        ids = np.repeat(np.arange(len(paths)), lengths)
+        self.first = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        self.last = self.first + lengths - 1
+        self.points = np.concatenate([np.asarray(path, dtype=float).reshape(-1, 3)
+                                      for path in paths])
+        self.start = np.asarray(starts, dtype=float)
+        # time since each node's start; every node gets its own key range,
+        # which makes the flat key array sorted for searchsorted
+        elapsed = (np.arange(len(ids)) - self.first[ids]) * dt
+        self.duration = elapsed[self.last]
+        self.span = self.duration.max() + 1 if len(ids) else 1
+        self.node_key = np.arange(len(paths)) * self.span
+        self.keys = elapsed + self.node_key[ids]
+
+    def positions(self, t, reverse=False):
+        """Positions of all nodes at time t
+        :param t: time since the beginning of the repetition
+        :param reverse: walks the paths from the end to the beginning"""
+        elapsed = np.clip(t - self.start, 0, self.duration)
+        if reverse:
+            elapsed = self.duration - elapsed
+        query = elapsed + self.node_key
+        idx = np.searchsorted(self.keys, query, side='right') - 1
+        idx = np.clip(idx, self.first, self.last)
+        nxt = np.minimum(idx + 1, self.last)
+        step = self.keys[nxt] - self.keys[idx]
+        frac = np.divide(query - self.keys[idx], step,
+                         out=np.zeros_like(step), where=step > 0)
+        return self.points[idx] + frac[:, None] * (self.points[nxt] - self.points[idx])
 
 
 class Tracked(Mobility):
@@ -549,6 +2436,8 @@ class Tracked(Mobility):
 
     def start_thread(self, **kwargs):
         debug('Starting mobility thread...\n')
+        self.config_link_params(**kwargs)
+        self.config_history(**kwargs)
         Mobility.thread_ = thread(target=self.configure, kwargs=kwargs)
         Mobility.thread_.daemon = True
         Mobility.thread_._keep_alive = True
@@ -584,65 +2473,63 @@ class Tracked(Mobility):
     def run(self, mob_nodes, draw, coordinate, dim, mob_start_time=0,
             mob_stop_time=10, reverse=False, mob_rep=1, **kwargs):
 
+        if not coordinate:
+            coordinate = {}
+            for node in mob_nodes:
+                self.calculate_diff_time(node)
+                coordinate[node] = self.create_coord(node, tracked=True)
+
+        nodes = [node for node in coordinate if len(coordinate[node])]
+        # with no tracked node the loop only waits for the stop time
+        paths = TrackedPaths([coordinate[node] for node in nodes],
+                             [node.startTime for node in nodes]) if nodes else None
+        Mobility.frame = PositionFrame(nodes, [node.position for node in nodes])
+
         for rep in range(mob_rep):
             t1 = time()
             i = 0.1
+            backwards = reverse and rep % 2 == 1
 
-            for node in mob_nodes:
-                node.time = 0
-                node.matrix_id = 0
-
-            if not coordinate:
-                coordinate = {}
-                for node in mob_nodes:
-                    self.calculate_diff_time(node)
-                    coordinate[node] = self.create_coord(node, tracked=True)
-
-            if reverse and rep % 2 == 1:
+            if backwards:
                 for node in mob_nodes:
                     fin_pos = node.params['finPos']
                     node.params['finPos'] = node.params['initPos']
                     node.params['initPos'] = fin_pos
 
-            while mob_start_time <= time() - t1 <= mob_stop_time:
+            while self.thread_._keep_alive and \
+                    mob_start_time <= time() - t1 <= mob_stop_time:
                 t2 = time()
                 if t2 - t1 >= i:
-                    for node, pos in coordinate.items():
-                        if (t2 - t1) >= node.startTime and node.time <= node.endTime:
-                            node.matrix_id += 1
-                            if reverse and rep % 2 == 1:
-                                if node.matrix_id < len(coordinate[node]):
-                                    pos = list(reversed(coordinate[node]))[node.matrix_id]
-                                else:
-                                    pos = list(reversed(coordinate[node]))[-1]
-                            else:
-                                if node.matrix_id < len(coordinate[node]):
-                                    pos = pos[node.matrix_id]
-                                else:
-                                    pos = pos[len(coordinate[node]) - 1]
+                    if paths is not None:
+                        xyz = paths.positions(t2 - t1, reverse=backwards)
+                        WmediumdPositions.begin()
+                        for node, pos in self.frame.commit(xyz):
                             self.set_pos(node, pos)
-                            node.time += 0.1
                             if draw:
                                 node_update = getattr(node, dim)
                                 node_update()
+                        WmediumdPositions.flush()
                     PlotGraph.pause()
                     i += 0.1
-                while self.pause_simulation:
-                    pass
+                else:
+                    self.wait_until(t1 + i)
+                self.wait_if_paused()
             if rep == mob_rep:
                 self.thread_._keep_alive = False
 
+    @staticmethod
+    def parse_coord(node):
+        "node.coord strings ('x,y,z') parsed once into a (K, 3) array"
+        coord = np.zeros((len(node.coord), 3))
+        for idx, c in enumerate(node.coord):
+            values = [float(v) for v in c.split(',')][:3]
+            coord[idx, :len(values)] = values
+        return coord
+
     @staticmethod
     def get_total_displacement(node):
-        x, y, z = 0, 0, 0
-        for num, coord in enumerate(node.coord):
-            if num > 0:
-                c0 = node.coord[num].split(',')
-                c1 = node.coord[num-1].split(',')
-                x += abs(float(c0[0]) - float(c1[0]))
-                y += abs(float(c0[1]) - float(c1[1]))
-                z += abs(float(c0[2]) - float(c1[2]))
-        return (x, y, z)
+        dif = np.abs(np.diff(Tracked.parse_coord(node), axis=0))
+        return tuple(dif.sum(axis=0).tolist())
 
     def create_coord(self, node, tracked=False):
         coord = []
@@ -659,11 +2546,6 @@ class Tracked(Mobility):
                 coord.append([node.coord[idx], node.coord[idx + 1]])
         return coord
 
-    def dir(self, p1, p2):
-        if p1 > p2:
-            return False
-        return True
-
     def mob_time(self, node):
         t1 = node.startTime
         if hasattr(node, 'time'):
@@ -672,70 +2554,37 @@ class Tracked(Mobility):
         t = t2 - t1
         return t
 
-    def get_points(self, node, a0, a1, total):
-        x1, y1 = float(a0[0]), float(a0[1])
-        z1 = float(a0[2]) if len(a0) > 2 else float(0)
-
-        x2, y2 = float(a1[0]), float(a1[1])
-        z2 = float(a1[2]) if len(a1) > 2 else float(0)
-        points = []
-        perc_dif = []
-        ldelta = [0, 0, 0]
-        faxes = [x1, y1, z1]  # first reference point
-        laxes = [x2, y2, z2]  # last refence point
-        dif = [abs(x2-x1), abs(y2-y1), abs(z2-z1)]   # difference first and last axes
-        for n in dif:
-            if n == 0:
-                perc_dif.append(0)
-            else:
-                # we get the difference among axes to calculate the speed
-                perc_dif.append((n * 100) / total[dif.index(n)])
-
-        dmin = min(x for x in perc_dif if x != 0)
-        t = self.mob_time(node) * 1000  # node simulation time
-        dt = t * (dmin / 100)
-
-        for n in perc_dif:
-            if n != 0:
-                ldelta[perc_dif.index(n)] = dif[perc_dif.index(n)] / dt
-
-        # direction of the node
-        dir = (self.dir(x1, x2), self.dir(y1, y2), self.dir(z1, z2))
-
-        for n in np.arange(0, dt, 1):
-            for delta in ldelta:
-                if dir[ldelta.index(delta)]:
-                    if n < dt - 1:
-                        faxes[ldelta.index(delta)] += delta
-                    else:
-                        faxes[ldelta.index(delta)] = laxes[ldelta.index(delta)]
-                else:
-                    if n < dt - 1:
-                        faxes[ldelta.index(delta)] -= delta
-                    else:
-                        faxes[ldelta.index(delta)] = laxes[ldelta.index(delta)]
-            points.append(self.get_position(faxes))
-        return points
-
     def set_coordinates(self, node):
-        coord = self.create_coord(node)
-        total = self.get_total_displacement(node)
-        points = []
-        for c in coord:
-            a0 = c[0].split(',')
-            a1 = c[1].split(',')
-            points += (self.get_points(node, a0, a1, total))
-
-        t = self.mob_time(node) * 10
-        interval = len(points) / t
-        pointsL = []
-        for id in np.arange(0, len(points), interval):
-            if id < len(points) - interval:
-                pointsL.append(points[int(id)])
-            else:
-                # set the last position according to the coordinates
-                pointsL.append(points[int(len(points)-1)])
-        return pointsL
+        """Samples the path given by node.coord every 0.1s
+        returns: (mob_time * 10, 3) array of positions"""
+        coord = self.parse_coord(node)
+        dif = np.abs(np.diff(coord, axis=0))
+        total = dif.sum(axis=0)
+        perc = np.divide(dif * 100, total, out=np.zeros_like(dif), where=total > 0)
+        # the axis with the smallest share of the displacement sets the
+        # duration of each segment, in ms
+        perc[perc == 0] = np.inf
+        dmin = perc.min(axis=1)
+        dmin[np.isinf(dmin)] = 0
+        t = self.mob_time(node)
+        steps = t * 1000 * dmin / 100
+        counts = np.ceil(steps).astype(int)
+        ends = np.cumsum(counts)
+        npoints = int(ends[-1]) if len(ends) else 0
+        if not npoints:
+            return coord[:1]
+
+        # indexes of the ms-resolution points kept at the 0.1s output rate,
+        # computed directly instead of building every ms point first
+        interval = npoints / (t * 10)
+        ids = np.arange(0, npoints, interval)
+        idx = np.where(ids < npoints - interval, ids.astype(int), npoints - 1)
+        seg = np.searchsorted(ends, idx, side='right')
+        local = idx - (ends[seg] - counts[seg])
+        # the last point of each segment is set according to the coordinates
+        frac = np.where(local == counts[seg] - 1, 1.0,
+                        (local + 1) / np.where(steps[seg] > 0, steps[seg], 1))
+        return coord[seg] + frac[:, None] * (coord[seg + 1] - coord[seg])
 
 
 # coding: utf-8
@@ -1003,13 +2852,7 @@ class MobileNode:
             return Position(0, 0)
         return self.positions[-1][1]
 
-    def position_at(self, t):
-        if not self.positions:
-            return Position(0, 0)
-        if t <= self.positions[0][0]:
-            return self.positions[0][1]
-        if t >= self.positions[-1][0]:
-            return self.positions[-1][1]
+    def bracket(self, t):
         # Binary search for the two waypoints that bracket time t.
         low, high = 0, len(self.positions) - 1
         while high - low > 1:
@@ -1018,6 +2861,16 @@ class MobileNode:
                 high = mid
             else:
                 low = mid
+        return low, high
+
+    def position_at(self, t):
+        if not self.positions:
+            return Position(0, 0)
+        if t <= self.positions[0][0]:
+            return self.positions[0][1]
+        if t >= self.positions[-1][0]:
+            return self.positions[-1][1]
+        low, high = self.bracket(t)
         t_low, pos_low = self.positions[low]
         t_high, pos_high = self.positions[high]
         fraction = (t - t_low) / (t_high - t_low)
@@ -1025,6 +2878,22 @@ class MobileNode:
         y = pos_low.y + fraction * (pos_high.y - pos_low.y)
         return Position(x, y)
 
+    def segment_at(self, t):
+        """Linear segment the node is on at time t
+        returns: (start time, (x, y), (vx, vy), end time)"""
+        if not self.positions or t >= self.positions[-1][0]:
+            pos = self.position_at(t)
+            return (t, (pos.x, pos.y), (0.0, 0.0), t)
+        if t < self.positions[0][0]:
+            pos = self.positions[0][1]
+            return (t, (pos.x, pos.y), (0.0, 0.0), self.positions[0][0])
+        low, high = self.bracket(t)
+        t_low, pos_low = self.positions[low]
+        t_high, pos_high = self.positions[high]
+        dt = t_high - t_low
+        return (t_low, (pos_low.x, pos_low.y),
+                ((pos_high.x - pos_low.x) / dt, (pos_high.y - pos_low.y) / dt), t_high)
+
     def change_times(self):
         return [t for t, pos in self.positions]
 
@@ -1038,7 +2907,8 @@ class MobileNode:
 class Pursue:
 
     def __init__(self, mob_nodes, x=200.0, y=200.0, minspeed=0.5, maxspeed=1.5,
-                 aggressiveness=0.5, pursueRandomnessMagnitude=0.5, random_seed=1739098452062):
+                 aggressiveness=0.5, pursueRandomnessMagnitude=0.5, random_seed=1739098452062,
+                 clock=None):
 
         self.nodes_count = len(mob_nodes)
         self.mob_nodes = mob_nodes
@@ -1049,6 +2919,7 @@ class Pursue:
         self.aggressiveness = aggressiveness
         self.pursueRandomnessMagnitude = pursueRandomnessMagnitude
         self.random_seed = random_seed
+        self.clock = clock or SimulationClock()
         random.seed(self.random_seed)
 
         # Initialize simulation time.
@@ -1115,8 +2986,9 @@ class Pursue:
         """
         Infinite iterator that yields current positions for all nodes at fixed output intervals.
         """
-        output_timestep = 0.1
+        frame = 0
         while True:
+            self.t = self.clock.frame_time(frame)
             # Extend the group leader's trajectory until it covers the current simulation time.
             self.update_ref()
             # Extend each node's trajectory similarly.
@@ -1131,7 +3003,11 @@ class Pursue:
             """self.traceFile.flush()  # Ensure the buffer is written out immediately."""
 
             yield pos_list
-            self.t += output_timestep
+            frame += 1
+
+    def segments(self):
+        "Linear segment of each node at the time of the last frame"
+        return [node.segment_at(self.t) for node in self.nodes]
 
 class ManhattanGridMobility(object):
     class Position(object):
@@ -1152,7 +3028,7 @@ class ManhattanGridMobility(object):
                  xblocks=10, yblocks=10, updateDist=5.0, turnProb=0.5,
                  speedChangeProb=0.2, minSpeed=0.5, meanSpeed=3.0,
                  speedStdDev=0.2, pauseProb=0.0, maxPause=120.0,
-                 randomSeed=1739481558215):
+                 randomSeed=1739481558215, clock=None, trace=None):
         
         self.mob_nodes = mob_nodes
         self.nodes_count = len(mob_nodes)
@@ -1220,11 +3096,9 @@ class ManhattanGridMobility(object):
             self.node_state.append(state)
 
         # Set the fixed timestep for continuous updates.
-        self.timestep = 0.1
-
-     # Open trace file for output.
-        self.traceFile = open("trace_manhattan.csv", "w")
-        self.traceFile.write("node_id time x y\n")
+        self.clock = clock or SimulationClock()
+        self.timestep = self.clock.timestep
+        self.trace = trace  # frame sink of the model trace, if any
 
     def get_new_pos(self, src, dist, dir):
         if dir == 0:  # up
@@ -1368,17 +3242,31 @@ class ManhattanGridMobility(object):
         Infinite iterator that yields synchronized positions for all nodes
         at fixed timesteps. Each yield is a list of (x, y, 0.0) tuples.
         """
-        current_time = 0.0
+        frame = 0
         while True:
+            current_time = self.t = self.clock.frame_time(frame)
             positions = []
             for idx, state in enumerate(self.node_state):
                 self.update_node(state, self.timestep)
                 pos = state['pos']
                 positions.append((round(pos.x, 2), round(pos.y, 2), 0.0))
-                # Write trace for each node: node_id, current_time, x, y.
-                self.traceFile.write("{} {:.2f} {:.2f} {:.2f}\n".format(idx, current_time, pos.x, pos.y))
+            if self.trace is not None:
+                self.trace(current_time, np.array(
+                    [(state['pos'].x, state['pos'].y) for state in self.node_state]))
             yield positions
-            current_time += self.timestep
+            frame += 1
+
+    def segments(self):
+        """Linear segment of each node at the time of the last frame: it
+        keeps its direction until the next grid crossing"""
+        units = {0: (0.0, 1.0), 1: (0.0, -1.0), 2: (1.0, 0.0), 3: (-1.0, 0.0)}
+        segments = []
+        for state in self.node_state:
+            pos, speed = state['pos'], state['speed']
+            ux, uy = units.get(state['direction'], (0.0, 0.0))
+            end = self.t + state['griddist'] / speed if speed > 0 else self.t
+            segments.append((self.t, (pos.x, pos.y), (ux * speed, uy * speed), end))
+        return segments
  
 
 class TIMM_Node(object):
@@ -1413,6 +3301,7 @@ class TIMMMobility(object):
                  Slow_speed=[0.577, 0.106],
                  Fast_speed=[1.037, 0.212],
                  randomSeed=1739281330759,
+                 clock=None, trace=None,
                  **kwargs):
         self.mob_nodes = mob_nodes
         self.x = x
@@ -1428,6 +3317,7 @@ class TIMMMobility(object):
         self.slow_speed = Slow_speed[0]
         self.fast_speed = Fast_speed[0]
         self.randomSeed = randomSeed
+        self.clock = clock or SimulationClock()
 
         print("TIMMMobility Model Parameters:")
         print("  Area: {} x {}".format(self.x, self.y))
@@ -1492,11 +3382,8 @@ class TIMMMobility(object):
         for group_id in range(len(self.Group_size)):
             start_time = self.Group_starttimes[group_id] if group_id < len(self.Group_starttimes) else 0.0
             heapq.heappush(self.event_queue, (start_time, group_id))
-        
 
-       # Open trace file for output.
-        self.traceFile = open("trace_TIMM.csv", "w")
-        self.traceFile.write("node_id time x y\n")
+        self.trace = trace  # frame sink of the model trace, if any
 
     def _parse_building_graph(self, filepath):
         g = nx.Graph()
@@ -1537,9 +3424,9 @@ class TIMMMobility(object):
         at fixed timesteps (e.g., every 0.1 seconds). At each timestep, it processes
         all events scheduled up to the current time and then yields the current positions.
         """
-        timestep = 0.1
-        current_time = 0.0
+        frame = 0
         while True:
+            current_time = self.t = self.clock.frame_time(frame)
             # Process all events scheduled up to current_time.
             while self.event_queue and self.event_queue[0][0] <= current_time:
                 t, group_id = heapq.heappop(self.event_queue)
@@ -1583,6 +3470,7 @@ class TIMMMobility(object):
                         heapq.heappush(self.event_queue, (group_next_event, group_id))
             # Yield the latest positions for all nodes.
             positions = []
+            exact = []
             for node_id in range(1, self.nn + 1):
                 wp_list = self.waypoints[node_id]
                 last_wp = wp_list[0]
@@ -1593,10 +3481,28 @@ class TIMMMobility(object):
                         break
                 pos = last_wp[1]
                 positions.append((round(pos[0], 2), round(pos[1], 2), 0.0))
-                self.traceFile.write("{} {:.2f} {:.2f} {:.2f}\n".format(node_id, current_time, pos[0], pos[1]))
+                exact.append(pos[:2])
+            if self.trace is not None:
+                self.trace(current_time, np.array(exact, dtype=float))
             yield positions
-            current_time += timestep
-
+            frame += 1
+
+    def segments(self):
+        """Segment of each node at the time of the last frame: nodes stay
+        on the vertex last reached until their next waypoint time"""
+        segments = []
+        for node_id in range(1, self.nn + 1):
+            wp_list = self.waypoints[node_id]
+            last_wp, end = wp_list[0], float('inf')
+            for event in wp_list:
+                if event[0] <= self.t:
+                    last_wp = event
+                else:
+                    end = event[0]
+                    break
+            pos = last_wp[1]
+            segments.append((self.t, (pos[0], pos[1]), (0.0, 0.0), end))
+        return segments
 
 
 # Define basic node states and event types
@@ -1622,7 +3528,7 @@ class Event:
 class SWIMMobility:
     def __init__(self, mob_nodes, x=200.0, y=200.0, nodeRadius=0.1, cellDistanceWeight=0.5, nodeSpeedMultiplier=0.1,
                  waitingTimeExponent=2.0, waitingTimeUpperBound=50.0,
-                 randomSeed=123456789):
+                 randomSeed=123456789, clock=None, trace=None):
         
         self.nn = len(mob_nodes)
         self.area_x = x
@@ -1633,6 +3539,7 @@ class SWIMMobility:
         self.waitingTimeExponent = waitingTimeExponent
         self.waitingTimeUpperBound = waitingTimeUpperBound
         self.randomSeed = randomSeed
+        self.clock = clock or SimulationClock()
 
         self.rng = random.Random(self.randomSeed)
 
@@ -1690,9 +3597,7 @@ class SWIMMobility:
         for i in range(self.nn):
             heapq.heappush(self.eventQueue, Event(EventType.START_WAITING, i, -1, 0.0))
 
-        # Open trace file for output (retained as in original implementation).
-        self.traceFile = open("trace_SWIM.csv", "w")
-        self.traceFile.write("node_id time x y\n")
+        self.trace = trace  # frame sink of the model trace, if any
 
     def getCellIndexFromPos(self, pos):
         row = int(pos[1] / self.cellLength)
@@ -1753,20 +3658,21 @@ class SWIMMobility:
         Infinite iterator that yields synchronized positions for all nodes at fixed timesteps.
         Each yielded position is a list of (x, y, 0.0) tuples.
         """
-        timestep = 0.1
-        current_time = 0.0
+        frame = 0
         while True:
+            current_time = self.clock.frame_time(frame)
             # Process events up to the current time.
             self.processEvents(current_time)
             positions = []
+            exact = []
             for node in self.nodes:
                 pos = self.updateNode(node, current_time)
                 positions.append((round(pos[0], 2), round(pos[1], 2), 0.0))
-                # Also write the node's position to the trace file.
-                self.traceFile.write("{} {:.2f} {:.2f} {:.2f}\n".format(node['id'], current_time, pos[0], pos[1]))
+                exact.append(pos[:2])
+            if self.trace is not None:
+                self.trace(current_time, np.array(exact, dtype=float))
             yield positions
-            current_time += timestep
-
+            frame += 1
 
 
 class StochasticWalk(object):
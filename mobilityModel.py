@@ -7,7 +7,6 @@ from mininet.log import setLogLevel, info
 from mn_wifi.cli import CLI
 from mn_wifi.net import Mininet_wifi
 from mn_wifi.mobility import Pursue
-from mn_wifi.mobility import export_mobility_trace_from_nodes
 from mn_wifi.mobility import ManhattanGridMobility
 from mn_wifi.mobility import TIMMMobility
 from mn_wifi.mobility import SWIMMobility
@@ -57,7 +56,8 @@ def topology(args):
                         x=100, y=100, model= 'Pursue',
                         minspeed=10.0, maxspeed=15.0,
                         aggressiveness=1.0, pursueRandomnessMagnitude=5.0,
-                        random_seed=54764759869 )
+                        random_seed=54764759869,
+                        mob_trace_file="mobility_trace.csv")
 
 
 
@@ -124,10 +124,8 @@ def topology(args):
         pass
     finally:
         info("*** Stopping network\n")
+        # the trace is written while running and closed by net.stop()
         net.stop()
-        # After stopping the network and before exporting the trace:
-        print("Exporting mobility trace from net.stations...")
-        export_mobility_trace_from_nodes(net.stations, "mobility_trace.csv")      
 
     """info("*** Running CLI\n")
     CLI(net)
@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+
+"""Offline mobility tools: trace generation and conversion, and the
+benchmarks of the mobility and link code. None of them needs root or a
+running network; the benchmarks use the stand-ins defined here"""
+
+import argparse
+import ast
+import math
+import os
+import random
+import socket
+import sys
+from os import getpid
+from subprocess import Popen
+from threading import Thread as thread
+from time import time, perf_counter
+
+import numpy as np
+
+from mn_wifi.mobility import Mobility, model, HeadlessNode, HeadlessModel, \
+    TickHistogram, TrajectoryCache, WmediumdPositions, WpaSupplicants, \
+    generate_trace
+from mn_wifi.traceFormats import BinaryTrace, CompressedTrace, frame_writer, \
+    read_csv_trace, csv_to_binary, binary_to_csv
+from mn_wifi.wmediumdConnector import w_cst, wmediumd_mode
+
+
+class HeadlessIntf(object):
+    "Wireless interface stand-in: association bookkeeping only"
+
+    def __init__(self, node, range=100):
+        self.node = node
+        self.range = range
+        self.associatedTo = None
+        self.apsInRange = {}
+        self.stationsInRange = {}
+        self.associatedStations = []
+        self.rssi = 0
+        self.encrypt = ''
+        self.ieee80211r = None
+        self.bgscan_module = None
+        self.active_scan = None
+
+    def associate_infra(self, ap_intf):
+        self.associatedTo = ap_intf
+
+    def disconnect(self, ap_intf):
+        self.associatedTo = None
+
+
+class WmediumdStandIn(object):
+    """Local stand-in for the wmediumd server: acknowledges the position
+    updates written on sock and counts them"""
+
+    def __init__(self):
+        self.sock, peer = socket.socketpair()
+        self.messages = 0
+        self.positions = {}  # mac -> last (x, y, z)
+        self.thread_ = thread(name='wmediumdStandIn', target=self.serve,
+                              args=(peer,))
+        self.thread_.daemon = True
+        self.thread_.start()
+
+    def serve(self, peer):
+        request, response = WmediumdPositions.request, WmediumdPositions.response
+        buf = b''
+        while True:
+            data = peer.recv(1 << 16)
+            if not data:
+                break
+            buf += data
+            size = len(buf) - len(buf) % request.size
+            replies = []
+            for msg in request.iter_unpack(buf[:size]):
+                self.messages += 1
+                self.positions[msg[1]] = msg[2:]
+                replies.append(response.pack(
+                    w_cst.WSERVER_POSITION_UPDATE_RESPONSE_TYPE,
+                    *msg, w_cst.WUPDATE_SUCCESS))
+            buf = buf[size:]
+            peer.sendall(b''.join(replies))
+        peer.close()
+
+    def close(self):
+        self.sock.close()
+        self.thread_.join()
+
+
+def bench_trace(mob_model, nr_nodes, duration, directory='.', **kwargs):
+    """Sizes and write/read times of one headless run in each trace format
+    returns: list of (format, bytes, seconds to write, seconds to read)"""
+    class Frames(list):
+        def __call__(self, t, array):
+            self.append((t, array.copy()))
+
+    nodes = [HeadlessNode('sta%d' % (n + 1)) for n in range(nr_nodes)]
+    runner = HeadlessModel(duration, mob_model=mob_model, **kwargs)
+    frames = Frames()
+    runner.frame_sinks.append(frames)
+    runner.run(nodes)
+    Mobility.close_trace()
+    times, arrays = [t for t, _ in frames], [a for _, a in frames]
+    timestep = runner.clock.timestep
+    readers = {'csv': lambda name: read_csv_trace(name),
+               'binary': lambda name: np.array(BinaryTrace(name).data),
+               'zlib': lambda name: CompressedTrace(name).frames(),
+               'lzma': lambda name: CompressedTrace(name).frames()}
+    extensions = {'csv': '.csv', 'binary': BinaryTrace.extension,
+                  'zlib': CompressedTrace.extension, 'lzma': CompressedTrace.extension}
+    results = []
+    for trace_format in ('csv', 'binary', 'zlib', 'lzma'):
+        filename = os.path.join(directory, 'bench_trace' + extensions[trace_format])
+        start = perf_counter()
+        writer = frame_writer(filename, nodes, timestep, trace_format)
+        writer.write(times, arrays)
+        writer.close()
+        written = perf_counter() - start
+        start = perf_counter()
+        readers[trace_format](filename)
+        results.append((trace_format, os.path.getsize(filename), written,
+                        perf_counter() - start))
+        os.unlink(filename)
+    return results
+
+
+def bench_links(nr_aps, nr_stations, ap_range=50.0, spacing=60.0, passes=3):
+    """Times config_links over every station, nodes spread uniformly
+    :param spacing: mean distance between neighbouring APs
+    returns: (seconds per pass with the link matrix narrowed down by the
+    AP grid, with the full matrix, with the full scan)"""
+    rng = random.Random(1)
+    side = spacing * math.ceil(math.sqrt(nr_aps))
+
+    def place(name):
+        node = HeadlessNode(name)
+        node.position = (rng.uniform(0, side), rng.uniform(0, side), 0)
+        node.wintfs = {0: HeadlessIntf(node, ap_range)}
+        return node
+
+    mob = Mobility()
+    mob.aps = [place('ap%d' % (n + 1)) for n in range(nr_aps)]
+    mob.stations = [place('sta%d' % (n + 1)) for n in range(nr_stations)]
+    results = []
+    for use_link_matrix, use_ap_grid in ((True, True), (True, False), (False, False)):
+        mob.use_link_matrix, mob.use_ap_grid = use_link_matrix, use_ap_grid
+        mob.config_links(mob.stations)  # warm up: associations, index
+        start = perf_counter()
+        for _ in range(passes):
+            mob.config_links(mob.stations)
+        results.append((perf_counter() - start) / passes)
+    Mobility.ap_index = None
+    Mobility.invalidate_link_plan()
+    return tuple(results)
+
+
+def bench_wmediumd(mob_model, nr_nodes, duration, epsilon=0.0, **kwargs):
+    """Counts the wmediumd position updates of a headless run, sent to a
+    WmediumdStandIn in interference mode
+    returns: (messages, socket writes, updates within epsilon)"""
+    class WmIntf(object):
+        def __init__(self, mac):
+            self.mac = mac
+
+        def get_intf_mac(self):
+            return self.mac
+
+    nodes = [HeadlessNode('sta%d' % (n + 1)) for n in range(nr_nodes)]
+    for n, node in enumerate(nodes):
+        node.wmIfaces = [WmIntf('02:00:00:00:%02x:%02x' % (n >> 8 & 255, n & 255))]
+    server = WmediumdStandIn()
+    mode = wmediumd_mode.mode
+    wmediumd_mode.mode = w_cst.INTERFERENCE_MODE
+    WmediumdPositions.reset()
+    WmediumdPositions.sock = server.sock
+    try:
+        HeadlessModel(duration, mob_model=mob_model,
+                      mob_wmediumd_epsilon=epsilon, **kwargs).run(nodes)
+    finally:
+        wmediumd_mode.mode = mode
+        WmediumdPositions.sock = None
+        server.close()
+    return (WmediumdPositions.messages, WmediumdPositions.writes,
+            WmediumdPositions.suppressed)
+
+
+def bench_handover(nr_stations, in_process=True):
+    """Times ap_out_of_range for stations leaving a WPA AP, each with a
+    stand-in wpa_supplicant process (a sleeping python with the same
+    command line) and staconf file to tear down
+    returns: TickHistogram of the seconds per handover"""
+    mob = Mobility()
+    ap = HeadlessNode('ap1')
+    ap_intf = HeadlessIntf(ap)
+    ap_intf.encrypt = 'wpa'
+    procs, hist = [], TickHistogram()
+    in_process, WpaSupplicants.in_process = WpaSupplicants.in_process, in_process
+    try:
+        intfs = []
+        for n in range(nr_stations):
+            sta = HeadlessNode('sta%d' % (n + 1))
+            intf = HeadlessIntf(sta)
+            intf.name, intf.id = '%s-wlan0' % sta, 0
+            pidfile = mob.get_pidfile(intf)
+            proc = Popen(['wpa_supplicant', '-c', 'import time; time.sleep(600)',
+                          '-B', '-Dnl80211', '-P', pidfile, '-i', intf.name],
+                         executable=sys.executable)
+            procs.append(proc)
+            with open(pidfile, 'w') as f:
+                f.write('%d\n' % proc.pid)
+            for name in (intf.name, sta):
+                open('%s_0.staconf' % name, 'w').close()
+            intf.associatedTo = ap_intf
+            intfs.append(intf)
+        for intf in intfs:
+            start = perf_counter()
+            mob.ap_out_of_range(intf, ap_intf)
+            hist.record(perf_counter() - start)
+    finally:
+        WpaSupplicants.in_process = in_process
+        for proc in procs:
+            proc.kill()
+            proc.wait()
+        for n in range(nr_stations):
+            for filename in ('mn%d_sta%d_0_wpa.pid' % (getpid(), n + 1),
+                             'sta%d-wlan0_0.staconf' % (n + 1),
+                             'sta%d_0.staconf' % (n + 1)):
+                if os.path.exists(filename):
+                    os.unlink(filename)
+    return hist
+
+
+def parse_model_arg(arg):
+    "Parses key=value; values are Python literals or plain strings"
+    key, _, value = arg.partition('=')
+    try:
+        value = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        pass
+    return key, value
+
+
+def main(argv=None):
+    "Command line entry point: examples/mobilityTools.py <command> ..."
+    parser = argparse.ArgumentParser()
+    cmds = parser.add_subparsers(dest='cmd')
+    cmds.required = True
+    gen = cmds.add_parser('generate', help='generate a mobility trace offline')
+    gen.add_argument('-m', '--model', required=True, choices=model.mob_models)
+    gen.add_argument('-n', '--nodes', type=int, default=10)
+    gen.add_argument('-d', '--duration', type=float, default=60.0,
+                     help='model time to generate, in seconds')
+    gen.add_argument('-t', '--timestep', type=float, default=0.1,
+                     help='model seconds per frame (%s: %s)' % (
+                         ', '.join(model.untimed_models), model.untimed_timestep))
+    gen.add_argument('-o', '--output', default='mobility_trace.csv')
+    gen.add_argument('-f', '--format', choices=['csv', 'binary', 'compressed', 'zlib', 'lzma'],
+                     help='trace format; by default from the output extension')
+    gen.add_argument('--seed', type=int, default=1)
+    gen.add_argument('--max-x', type=float, default=100)
+    gen.add_argument('--max-y', type=float, default=100)
+    gen.add_argument('--min-v', type=float, default=10)
+    gen.add_argument('--max-v', type=float, default=10)
+    gen.add_argument('--prefetch', type=int, default=0,
+                     help='frames the model may compute ahead of the writer')
+    gen.add_argument('--cache', metavar='DIR',
+                     help='trajectory cache directory')
+    gen.add_argument('--cache-size', type=int, default=TrajectoryCache.max_size,
+                     help='cache size limit, in bytes')
+    gen.add_argument('-p', '--param', action='append', default=[],
+                     metavar='KEY=VALUE', help='model argument, e.g. minspeed=1.0')
+    bench = cmds.add_parser('bench-links',
+                            help='time link passes as the number of APs grows')
+    bench.add_argument('--aps', type=int, default=300)
+    bench.add_argument('--stations', type=int, default=2000)
+    bench.add_argument('--range', type=float, default=50.0)
+    bench.add_argument('--spacing', type=float, default=60.0)
+    bench.add_argument('--passes', type=int, default=3)
+    wm = cmds.add_parser('bench-wmediumd',
+                         help='count wmediumd position updates of a model')
+    wm.add_argument('-m', '--model', default='RandomWalk', choices=model.mob_models)
+    wm.add_argument('-n', '--nodes', type=int, default=50)
+    wm.add_argument('-d', '--duration', type=float, default=60.0)
+    wm.add_argument('--epsilon', type=float, action='append',
+                    help='minimum movement in m; may be repeated')
+    conv = cmds.add_parser('convert', help='convert between CSV and binary traces')
+    conv.add_argument('src', help='CSV trace, binary trace ending in .mntrace '
+                      'or compressed trace ending in .mnz')
+    conv.add_argument('dst')
+    conv.add_argument('-t', '--timestep', type=float,
+                      help='frame length of the binary trace; by default the '
+                           'median time between two rows of a node')
+    conv.add_argument('--layout', choices=['export', 'model'], default='export',
+                      help='CSV layout: node_id,time,x,y or node_id time x y')
+    bt = cmds.add_parser('bench-trace', help='compare the size and speed of trace formats')
+    bt.add_argument('-m', '--model', default='RandomWalk', choices=model.mob_models)
+    bt.add_argument('-n', '--nodes', type=int, default=50)
+    bt.add_argument('-d', '--duration', type=float, default=600.0)
+    ho = cmds.add_parser('bench-handover',
+                         help='time handovers that tear down wpa_supplicant')
+    ho.add_argument('-n', '--stations', type=int, default=100)
+    args = parser.parse_args(argv)
+
+    if args.cmd == 'convert':
+        start = time()
+        if args.src.endswith(BinaryTrace.extension):
+            frames = binary_to_csv(args.src, args.dst, args.layout)
+        elif args.src.endswith(CompressedTrace.extension):
+            trace = CompressedTrace(args.src)
+            frames = trace.to_csv(args.dst, args.layout)
+            trace.close()
+        else:
+            frames = csv_to_binary(args.src, args.dst, args.timestep)
+        print("{} frames converted to {} in {:.2f}s ({} -> {} bytes)".format(
+            frames, args.dst, time() - start, os.path.getsize(args.src),
+            os.path.getsize(args.dst)))
+        return
+
+    if args.cmd == 'bench-trace':
+        frames = int(round(args.duration / model.frame_length(args.model)))
+        print("{} nodes x {} frames of {}".format(args.nodes, frames, args.model))
+        print("{:>7} {:>11} {:>9} {:>10} {:>10}".format(
+            'format', 'bytes', 'ratio', 'write(s)', 'read(s)'))
+        results = bench_trace(args.model, args.nodes, args.duration)
+        csv_size = results[0][1]
+        for name, size, written, read in results:
+            print("{:>7} {:>11} {:>9.1f} {:>10.3f} {:>10.3f}".format(
+                name, size, csv_size / float(size), written, read))
+        return
+
+    if args.cmd == 'bench-handover':
+        print("{:>10} {:>10} {:>10} {:>10}".format('teardown', 'p50(ms)', 'p99(ms)', 'total(s)'))
+        for name, in_process in (('in-process', True), ('shell', False)):
+            hist = bench_handover(args.stations, in_process)
+            print("{:>10} {:>10.3f} {:>10.3f} {:>10.2f}".format(
+                name, hist.percentile(0.5) * 1e3, hist.percentile(0.99) * 1e3,
+                hist.total))
+        return
+
+    if args.cmd == 'bench-wmediumd':
+        frames = int(round(args.duration / model.frame_length(args.model)))
+        print("{} nodes x {} frames: {} updates without batching".format(
+            args.nodes, frames, args.nodes * frames))
+        print("{:>8} {:>9} {:>7} {:>11}".format(
+            'epsilon', 'messages', 'writes', 'suppressed'))
+        for epsilon in args.epsilon or [0.0, 0.1, 0.5]:
+            counts = bench_wmediumd(args.model, args.nodes, args.duration, epsilon)
+            print("{:>8} {:>9} {:>7} {:>11}".format(epsilon, *counts))
+        return
+
+    if args.cmd == 'bench-links':
+        print("{:>6} {:>9} {:>10} {:>12} {:>10}".format(
+            'aps', 'stations', 'grid(ms)', 'matrix(ms)', 'scan(ms)'))
+        for nr_aps in sorted(set(max(args.aps >> n, 1) for n in range(4))):
+            grid, matrix, scan = bench_links(nr_aps, args.stations, args.range,
+                                             args.spacing, args.passes)
+            print("{:>6} {:>9} {:>10.1f} {:>12.1f} {:>10.1f}".format(
+                nr_aps, args.stations, grid * 1e3, matrix * 1e3, scan * 1e3))
+        return
+
+    nodes = [HeadlessNode('sta%d' % (n + 1), min_v=args.min_v, max_v=args.max_v)
+             for n in range(args.nodes)]
+    kwargs = dict(parse_model_arg(arg) for arg in args.param)
+    start = time()
+    frames = generate_trace(args.model, nodes, args.duration, args.output,
+                            mob_timestep=args.timestep, seed=args.seed,
+                            mob_prefetch=args.prefetch, mob_cache=args.cache,
+                            mob_trace_format=args.format,
+                            mob_cache_size=args.cache_size,
+                            max_x=args.max_x, max_y=args.max_y, **kwargs)
+    print("{} frames x {} nodes written to {} in {:.2f}s".format(
+        frames, len(nodes), args.output, time() - start))
+
+
+if __name__ == '__main__':
+    main()
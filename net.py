@@ -7,7 +7,7 @@ import re
 import socket
 
 from itertools import chain, groupby
-from threading import Thread as thread
+from threading import Thread as thread, current_thread
 from time import sleep
 from sys import exit
 
@@ -29,7 +29,8 @@ from mn_wifi.link import IntfWireless, wmediumd, _4address, HostapdConfig, \
     master, managed, physicalMesh, PhysicalWifiDirectLink, _4addrClient, \
     _4addrAP, phyAP
 from mn_wifi.mobility import Tracked as TrackedMob, model as MobModel, \
-    Mobility as mob, ConfigMobility, ConfigMobLinks
+    Mobility as mob, ConfigMobility, ConfigMobLinks, MobilityStats, \
+    RSSIKernels, TCBatch, WmediumdPositions, SNRUpdates
 from mn_wifi.module import Mac80211Hwsim
 from mn_wifi.node import AP, Station, Car, OVSKernelAP, physicalAP
 from mn_wifi.plot import Plot2D, Plot3D, PlotGraph
@@ -147,6 +148,26 @@ class Mininet_wifi(Mininet, Mininet_IoT, Mininet_WWAN, Mininet_btvirt):
         self.mob_start_time = 0
         self.mob_stop_time = 0
         self.mob_rep = 1
+        self.mob_timestep = 0.1  # model seconds per frame; untimed models use 0.5
+        self.mob_rt_factor = 1.0  # model time / wall time; 0 runs as fast as possible
+        self.mob_prefetch = 0  # frames the model may compute ahead; 0 disables it
+        self.mob_cache = None  # trajectory cache directory; None disables it
+        self.mob_cache_duration = 600  # model seconds stored per cache entry
+        self.mob_cache_size = 1 << 30  # bytes kept in the cache directory
+        self.mob_wmediumd_epsilon = 0.0  # m; smaller moves are not sent to wmediumd
+        self.mob_snr_delta = 0.0  # dB; smaller SNR changes are not sent to wmediumd
+        self.mob_snr_interval = 0.0  # minimum seconds between SNR updates of a link
+        self.mob_adaptive_links = False  # schedule link passes by speed and range edges
+        self.mob_link_max_interval = 1.0  # longest a moving station goes without a pass
+        self.mob_tc_batch = True  # one tc -batch per namespace and link pass
+        self.mob_predictive_handover = False  # passes at the range crossings of model segments
+        self.mob_history = 'all'  # position history: all, ring, decimate, spill or None
+        self.mob_history_seconds = 600.0  # ring: seconds of history kept
+        self.mob_history_interval = 1.0  # decimate: seconds between samples of a node
+        self.mob_history_file = None  # spill: file full history chunks go to
+        self.mob_trace_file = None  # trace of the mobile nodes, written during the run
+        self.mob_trace_format = None  # csv, binary or compressed; None picks it from the file extension
+        self.mob_model_trace = None  # trace_<model> file of some models: None, csv or binary
         self.seed = 1
         self.min_v = 1
         self.max_v = 10
@@ -345,6 +366,7 @@ class Mininet_wifi(Mininet, Mininet_IoT, Mininet_WWAN, Mininet_btvirt):
         node.terminate()
         nodes.remove(node)
         del self.nameToNode[node.name]
+        mob.invalidate_link_plan()
 
     def pos_to_array(self, node):
         pos = node.params['position']
@@ -450,6 +472,7 @@ class Mininet_wifi(Mininet, Mininet_IoT, Mininet_WWAN, Mininet_btvirt):
         self.addWlans(sta)
         self.stations.append(sta)
         self.nameToNode[name] = sta
+        mob.invalidate_link_plan()
         return sta
 
     def addCar(self, name, cls=None, **params):
@@ -535,6 +558,7 @@ class Mininet_wifi(Mininet, Mininet_IoT, Mininet_WWAN, Mininet_btvirt):
             self.pos_to_array(ap)
         self.addWlans(ap)
         self.aps.append(ap)
+        mob.invalidate_link_plan()
         return ap
 
     def setStaticRoute(self, node, ip=None, **params):
@@ -794,6 +818,10 @@ class Mininet_wifi(Mininet, Mininet_IoT, Mininet_WWAN, Mininet_btvirt):
 
     def build(self):
         "Build mininet-wifi."
+        TCBatch.reset()  # the new interfaces have none of the old qdiscs
+        # nor the positions and SNRs wmediumd was given
+        WmediumdPositions.reset()
+        SNRUpdates.reset()
         if self.topo:
             self.buildFromWirelessTopo(self.topo)
             if self.init_plot or self.init_Plot3D:
@@ -1140,6 +1168,10 @@ class Mininet_wifi(Mininet, Mininet_IoT, Mininet_WWAN, Mininet_btvirt):
         return stat_nodes, mob_nodes
 
     def setPropagationModel(self, **kwargs):
+        """:param rssi_table: link passes interpolate the RSSI on
+        precomputed RSSI-vs-distance tables"""
+        if 'rssi_table' in kwargs:
+            RSSIKernels.use_table = kwargs.pop('rssi_table')
         ppm.set_attr(self.noise_th, self.cca_th, **kwargs)
 
     def setInitialMediums(self, mediums):
@@ -1291,6 +1323,7 @@ class Mininet_wifi(Mininet, Mininet_IoT, Mininet_WWAN, Mininet_btvirt):
 
     def stopMobility(self, **kwargs):
         "Stops Mobility"
+        mob.close_trace()
         if self.allAutoAssociation and \
                 not self.configWiFiDirect and not self.config4addr:
             self.auto_association()
@@ -1300,6 +1333,25 @@ class Mininet_wifi(Mininet, Mininet_IoT, Mininet_WWAN, Mininet_btvirt):
             else:
                 setattr(self, key, kwargs.get(key))
 
+    @staticmethod
+    def enableMobilityStats(filename=None, interval=10.0):
+        """Records per-tick timings of the mobility and link threads
+        :params filename: periodic dump file (.csv, JSON lines otherwise)
+        :params interval: seconds between two dumps"""
+        MobilityStats.enable(filename=filename, interval=interval)
+
+    @staticmethod
+    def disableMobilityStats():
+        "Stops recording mobility timings and writes a last dump"
+        MobilityStats.disable()
+
+    @staticmethod
+    def getMobilityStats():
+        "Returns a summary of the mobility timings recorded so far"
+        if not MobilityStats.histograms:
+            return {}
+        return MobilityStats.snapshot()
+
     def get_mobility_params(self):
         "Set Mobility Parameters"
         mob_params = {}
@@ -1312,6 +1364,13 @@ class Mininet_wifi(Mininet, Mininet_IoT, Mininet_WWAN, Mininet_btvirt):
                       'pauseProb', 'maxPause', 'nodeRadius', 'cellDistanceWeight', 'nodeSpeedMultiplier', 'waitingTimeExponent', 'waitingTimeUpperBound']
         args = ['stations', 'cars', 'aps', 'draw', 'seed',
                 'roads', 'mob_start_time', 'mob_stop_time',
+                'mob_timestep', 'mob_rt_factor', 'mob_prefetch',
+                'mob_cache', 'mob_cache_duration', 'mob_cache_size',
+                'mob_wmediumd_epsilon', 'mob_snr_delta', 'mob_snr_interval',
+                'mob_adaptive_links', 'mob_link_max_interval', 'mob_tc_batch',
+                'mob_predictive_handover', 'mob_history', 'mob_history_seconds',
+                'mob_history_interval', 'mob_history_file', 'mob_trace_file',
+                'mob_trace_format', 'mob_model_trace',
                 'links', 'mob_model', 'mob_rep', 'reverse',
                 'ac_method', 'pointlist', 'n_groups', 'aggregation_epoch', 'epoch',
                 'velocity', 'xblocks', 'yblocks', 'x', 'y', 'random_seed',
@@ -1470,6 +1529,7 @@ class Mininet_wifi(Mininet, Mininet_IoT, Mininet_WWAN, Mininet_btvirt):
 
     def restore_links(self):
         # restore link params when it is manually set
+        tc = TCBatch() if TCBatch.enabled and self.mob_tc_batch else None
         for link in self.links:
             params = {}
             if 'bw' in link.intf1.params:
@@ -1479,7 +1539,13 @@ class Mininet_wifi(Mininet, Mininet_IoT, Mininet_WWAN, Mininet_btvirt):
             if 'loss' in link.intf1.params:
                 params['loss'] = link.intf1.params['loss']
             if params and 'delay' not in link.intf1.params and hasattr(link.intf1, 'configWLink'):
-                link.intf1.configWLink.set_tc(link.intf1.name, **params)
+                if tc is None:
+                    link.intf1.configWLink.set_tc(link.intf1.name, **params)
+                else:
+                    tc.record(link.intf1.node, link.intf1.configWLink.set_tc,
+                              link.intf1.name, **params)
+        if tc is not None:
+            tc.flush()
 
     def auto_association(self):
         "This is useful to make the users' life easier"
@@ -1499,6 +1565,7 @@ class Mininet_wifi(Mininet, Mininet_IoT, Mininet_WWAN, Mininet_btvirt):
                 mob.stations.remove(sta)
 
         mob.aps = self.aps
+        mob.invalidate_link_plan()
         nodes = self.aps + self.stations + self.cars
         for node in nodes:
             if hasattr(node, 'position'):
@@ -1533,12 +1600,12 @@ class Mininet_wifi(Mininet, Mininet_IoT, Mininet_WWAN, Mininet_btvirt):
     @staticmethod
     def stop_simulation():
         "Pause the simulation"
-        mob.pause_simulation = True
+        mob.pause()
 
     @staticmethod
     def start_simulation():
         "Start the simulation"
-        mob.pause_simulation = False
+        mob.resume()
 
     @staticmethod
     def setChannelEquation(**params):
@@ -1559,6 +1626,13 @@ class Mininet_wifi(Mininet, Mininet_IoT, Mininet_WWAN, Mininet_btvirt):
             parseData.thread_._keep_alive = False
         if mob.thread_:
             mob.thread_._keep_alive = False
+            mob.wakeup()
+            # the loop may still be handing a frame to the trace sinks
+            if mob.thread_ is not current_thread() and mob.thread_.is_alive():
+                mob.thread_.join(2)
+        mob.close_trace()
+        if MobilityStats.enabled:
+            MobilityStats.disable()
         if Energy.thread_:
             Energy.thread_._keep_alive = False
             sleep(1)
@@ -0,0 +1,318 @@
+"""Tests of the mobility bookkeeping that runs without a network:
+position frames, tracked paths, position history, SNR and tc updates"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from itertools import islice
+
+import numpy as np
+
+from mn_wifi.mobility import PositionFrame, TrackedPaths, PositionHistory, \
+    SNRUpdates, TCBatch, HandoverPredictor, SimulationClock, TrajectoryCache, \
+    LinkPlan, APIndex, LinkMatrix, Mobility
+
+
+class Node(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+class Intf(object):
+    "Records the SNR values sent to wmediumd"
+
+    def __init__(self):
+        self.sent = []
+
+    def setSNRWmediumd(self, ap_intf, snr):
+        self.sent.append(snr)
+
+
+class testPositionFrame(unittest.TestCase):
+
+    def setUp(self):
+        self.nodes = [Node('sta%d' % n) for n in range(3)]
+
+    def test_first_commit_reports_every_node(self):
+        frame = PositionFrame(self.nodes)
+        moved = frame.commit([(1, 2), (3, 4), (5, 6)])
+        self.assertEqual([node for node, _ in moved], self.nodes)
+        self.assertEqual(moved[1][1], (3.0, 4.0, 0.0))
+
+    def test_only_moved_nodes_are_reported(self):
+        frame = PositionFrame(self.nodes, [(1, 2, 0), (3, 4, 0), (5, 6, 0)])
+        self.assertEqual(frame.commit([(1, 2), (3, 4), (5, 6)]), [])
+        moved = frame.commit([(1, 2), (3, 4.5), (5, 6)])
+        self.assertEqual(moved, [(self.nodes[1], (3.0, 4.5, 0.0))])
+
+    def test_positions_are_rounded_to_centimetres(self):
+        frame = PositionFrame(self.nodes[:1], [(1, 1, 0)])
+        self.assertEqual(frame.commit([(1.001, 1.004)]), [])
+        self.assertEqual(frame.commit([(1.006, 1)]),
+                         [(self.nodes[0], (1.01, 1.0, 0.0))])
+
+    def test_frame_pos_follows_the_array(self):
+        frame = PositionFrame(self.nodes)
+        frame.commit([(1, 2, 3), (4, 5, 6), (7, 8, 9)])
+        self.assertEqual(self.nodes[2].frame_pos.tolist(), [7, 8, 9])
+
+    def test_no_nodes(self):
+        frame = PositionFrame([], [])
+        self.assertEqual(frame.commit(np.zeros((0, 2))), [])
+
+
+class testTrackedPaths(unittest.TestCase):
+
+    def setUp(self):
+        self.paths = TrackedPaths(
+            [[(0, 0, 0), (1, 0, 0), (2, 0, 0)], [(5, 5, 0), (5, 7, 0)]],
+            [0.0, 1.0], dt=0.1)
+
+    def test_interpolates_between_points(self):
+        xyz = self.paths.positions(0.15)
+        self.assertAlmostEqual(xyz[0][0], 1.5)
+        self.assertEqual(xyz[1].tolist(), [5, 5, 0])
+
+    def test_nodes_keep_their_own_start(self):
+        xyz = self.paths.positions(1.05)
+        self.assertEqual(xyz[0].tolist(), [2, 0, 0])
+        self.assertAlmostEqual(xyz[1][1], 6.0)
+
+    def test_reverse_walks_from_the_end(self):
+        xyz = self.paths.positions(0.0, reverse=True)
+        self.assertEqual(xyz[0].tolist(), [2, 0, 0])
+        self.assertEqual(xyz[1].tolist(), [5, 7, 0])
+
+    def test_single_point_path(self):
+        paths = TrackedPaths([[(3, 4, 0)]], [0.0])
+        self.assertEqual(paths.positions(10).tolist(), [[3, 4, 0]])
+
+
+class testPositionHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.node = Node('sta1')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def fill(self, history, times):
+        for t in times:
+            history.append(self.node, (t, 2 * t, 0), t=t)
+
+    def test_all_keeps_everything(self):
+        history = PositionHistory('all', capacity=4)
+        self.fill(history, np.arange(10.0))
+        t, xyz = history.get(self.node)
+        self.assertEqual(len(history), 10)
+        self.assertEqual(t.tolist(), list(range(10)))
+        self.assertEqual(xyz[:, 1].tolist(), list(range(0, 20, 2)))
+
+    def test_ring_keeps_the_last_seconds(self):
+        history = PositionHistory('ring', seconds=3.0, capacity=4)
+        self.fill(history, np.arange(20.0))
+        t, _ = history.get(self.node)
+        self.assertEqual(t.tolist(), [16, 17, 18, 19])
+
+    def test_decimate_keeps_one_sample_per_interval(self):
+        history = PositionHistory('decimate', interval=1.0)
+        self.fill(history, np.arange(0, 3.1, 0.5))
+        self.assertEqual(history.get(self.node)[0].tolist(), [0, 1, 2, 3])
+
+    def test_spill_writes_full_columns_to_the_file(self):
+        filename = os.path.join(self.dir, 'history.bin')
+        history = PositionHistory('spill', filename=filename, capacity=4)
+        self.fill(history, np.arange(10.0))
+        self.assertEqual(history.spilled, 8)
+        t, node, xyz = history.columns()
+        self.assertEqual(t.tolist(), list(range(10)))
+        self.assertEqual(node.tolist(), [0] * 10)
+        self.assertEqual(xyz[9].tolist(), [9, 18, 0])
+
+    def test_invalid_policies(self):
+        self.assertRaises(ValueError, PositionHistory, 'everything')
+        self.assertRaises(ValueError, PositionHistory, 'spill')
+
+
+class testSNRUpdates(unittest.TestCase):
+
+    def setUp(self):
+        SNRUpdates.reset()
+        self.delta, self.interval = SNRUpdates.delta, SNRUpdates.interval
+        SNRUpdates.delta, SNRUpdates.interval = 1.0, 0.0
+        self.intf, self.ap_intf = Intf(), Intf()
+
+    def tearDown(self):
+        SNRUpdates.delta, SNRUpdates.interval = self.delta, self.interval
+        SNRUpdates.reset()
+
+    def test_changes_within_delta_are_suppressed(self):
+        for snr in (20, 20.5, 21, 22.5):
+            SNRUpdates.update(self.intf, self.ap_intf, snr)
+        self.assertEqual(self.intf.sent, [20, 22.5])
+        self.assertEqual((SNRUpdates.sent, SNRUpdates.suppressed), (2, 2))
+
+    def test_out_of_range_skips_repeated_values_only(self):
+        SNRUpdates.update(self.intf, self.ap_intf, 20)
+        SNRUpdates.update(self.intf, self.ap_intf, -91, out_of_range=True)
+        SNRUpdates.update(self.intf, self.ap_intf, -91, out_of_range=True)
+        SNRUpdates.update(self.intf, self.ap_intf, 20.5)
+        self.assertEqual(self.intf.sent, [20, -91, 20.5])
+
+    def test_interval(self):
+        SNRUpdates.interval = 60.0
+        SNRUpdates.update(self.intf, self.ap_intf, 20)
+        SNRUpdates.update(self.intf, self.ap_intf, 30)
+        self.assertEqual(self.intf.sent, [20])
+
+    def test_a_new_run_sends_again(self):
+        SNRUpdates.update(self.intf, self.ap_intf, 20)
+        Mobility.config_link_params(mob_snr_delta=1.0)
+        SNRUpdates.update(self.intf, self.ap_intf, 20)
+        self.assertEqual(self.intf.sent, [20, 20])
+
+
+class testLinkMatrix(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(1)
+        self.aps = [self.place('ap%d' % n, rng.uniform(0, 500, 2), (30, 50)[n % 2])
+                    for n in range(40)]
+        self.stations = [self.place('sta%d' % n, rng.uniform(0, 500, 2))
+                         for n in range(200)]
+        self.plan = LinkPlan()
+
+    @staticmethod
+    def place(name, xy, range=50):
+        node = Node(name)
+        node.position = (round(xy[0], 2), round(xy[1], 2), 0)
+        intf = Intf()
+        intf.node, intf.range = node, range
+        node.wintfs = {0: intf}
+        return node
+
+    def links(self, grid):
+        return LinkMatrix(self.stations, APIndex(self.aps, self.plan, grid))
+
+    def test_grid_leaves_out_pairs_out_of_range_only(self):
+        grid, full = self.links(True), self.links(False)
+        self.assertLess(len(grid.dist), len(full.dist))
+        for sta in self.stations:
+            self.assertEqual(grid.aps_in_range(sta), full.aps_in_range(sta))
+            self.assertEqual(grid.in_range_cols(sta), full.in_range_cols(sta))
+
+    def test_slack_is_a_lower_bound(self):
+        grid, full = self.links(True), self.links(False)
+        self.assertTrue((grid.slack() <= full.slack()).all())
+
+    def test_distances_cover_every_ap(self):
+        links = self.links(True)
+        sta = self.stations[0]
+        dist = links.distances(sta)
+        self.assertEqual(len(dist), len(self.aps))
+        for ap, d in links.aps_in_range(sta).items():
+            self.assertEqual(dist[self.aps.index(ap)], d)
+
+
+class testTrajectoryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = TrajectoryCache(self.dir)
+        self.built = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def model(self):
+        "Two nodes walking along x, one metre per frame"
+        self.built += 1
+        n = 0
+        while True:
+            yield [(n, 0.0), (n, 1.0)]
+            n += 1
+
+    def test_record_stores_whole_entries(self):
+        frames = self.cache.record('k', self.model(), 4, 2)
+        self.assertEqual([xy[0][0] for xy in islice(frames, 6)], list(range(6)))
+        self.assertEqual(len(self.cache.load('k')), 4)
+
+    def test_hit_within_the_cache_does_not_build_the_model(self):
+        for _ in self.cache.record('k', islice(self.model(), 4), 4, 2):
+            pass
+        self.built = 0
+        frames = self.cache.replay('k', self.cache.load('k'), self.model)
+        replayed = [xy[0][0] for xy in islice(frames, 4)]
+        self.assertEqual(replayed, [0, 1, 2, 3])
+        self.assertEqual(self.built, 0)
+
+    def test_replay_goes_on_and_extends_the_entry(self):
+        for _ in self.cache.record('k', islice(self.model(), 4), 4, 2):
+            pass
+        frames = self.cache.replay('k', self.cache.load('k'), self.model)
+        self.assertEqual([xy[1][0] for xy in islice(frames, 10)], list(range(10)))
+        self.assertEqual(len(self.cache.load('k')), 8)
+
+
+class testHandoverPredictor(unittest.TestCase):
+
+    def test_select_before_the_clock_starts(self):
+        predictor = HandoverPredictor(SimulationClock(timestep=0.1))
+        stations = [Node('sta1'), Node('sta2')]
+        self.assertEqual(predictor.select(stations), (set(stations), {}))
+        self.assertIsNone(predictor.timeout())
+
+    def test_select_takes_changed_segments(self):
+        clock = SimulationClock(timestep=0.1)
+        predictor = HandoverPredictor(clock)
+        sta = Node('sta1')
+        predictor.publish([sta], [(0.0, (1, 2), (1, 0), 10.0)], 0.0)
+        clock.start()
+        ready, positions = predictor.select([])
+        self.assertEqual(ready, {sta})
+        self.assertAlmostEqual(positions[sta][1], 2.0)
+        self.assertEqual(predictor.select([sta]), (set(), {}))
+
+
+class testTCBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.batch = TCBatch()
+
+    def test_replace_is_keyed_by_the_object(self):
+        key = self.batch.key('tc qdisc replace dev sta1-wlan0 root handle 2: '
+                             'netem rate 54.0mbit latency 1ms')
+        self.assertEqual(key, ('qdisc', ('dev', 'sta1-wlan0'),
+                               ('handle', '2:'), 'root'))
+        self.assertEqual(key, self.batch.key(
+            'tc qdisc replace dev sta1-wlan0 root handle 2: netem rate 11.0mbit'))
+        self.assertNotEqual(key, self.batch.key(
+            'tc qdisc replace dev sta2-wlan0 root handle 2: netem rate 11.0mbit'))
+
+    def test_change_and_replace_share_keys(self):
+        self.assertEqual(
+            self.batch.key('tc class change dev ap1-wlan1 parent 1: classid 1:1 htb'),
+            self.batch.key('tc class replace dev ap1-wlan1 parent 1: classid 1:1 htb'))
+
+    def test_other_commands_are_never_merged(self):
+        line = 'tc qdisc add dev sta1-wlan0 root handle 1: htb'
+        self.assertNotEqual(self.batch.key(line), self.batch.key(line))
+
+    def test_later_replace_supersedes(self):
+        node = Node('sta1')
+        dropped = TCBatch.dropped
+        self.batch.add(node, 'tc qdisc replace dev sta1-wlan0 root netem rate 1mbit')
+        self.batch.add(node, 'tc qdisc replace dev sta1-wlan0 root netem rate 2mbit')
+        self.assertEqual(list(self.batch.pending[node].values()),
+                         ['tc qdisc replace dev sta1-wlan0 root netem rate 2mbit'])
+        self.assertEqual(TCBatch.dropped, dropped + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+"""Round trips of the mobility trace formats"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from mn_wifi.traceFormats import CSVFrameWriter, TraceStreamer, BinaryTrace, \
+    BinaryFrameWriter, CompressedTrace, CompressedFrameWriter, \
+    CompressedRowWriter, frame_writer, read_csv_trace, csv_to_binary, \
+    binary_to_csv
+
+
+class Frames(list):
+    "Writer keeping the frames it is given"
+    closed = False
+
+    def write(self, times, arrays):
+        self.extend(zip(times, arrays))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class testTraceFormats(unittest.TestCase):
+    nodes = ['sta1', 'sta2', 'sta3']
+    timestep = 0.1
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(1)
+        steps = rng.uniform(-1, 1, (50, len(self.nodes), 2))
+        # positions as the models yield them: rounded to centimetres
+        self.frames = np.round(50 + np.cumsum(steps, axis=0), 2)
+        self.times = np.arange(len(self.frames)) * self.timestep
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def write(self, writer):
+        writer.write(self.times, list(self.frames))
+        writer.close()
+
+    def test_binary_round_trip(self):
+        self.write(BinaryFrameWriter(self.path('t.mntrace'), self.nodes, self.timestep))
+        trace = BinaryTrace(self.path('t.mntrace'))
+        self.assertEqual(trace.nodes, self.nodes)
+        self.assertEqual(len(trace), len(self.frames))
+        np.testing.assert_allclose(trace.data, self.frames, atol=1e-4)
+        np.testing.assert_allclose(trace.times(), self.times)
+        self.assertEqual(trace.bounds[:2], [round(float(self.frames[..., 0].min()), 4),
+                                            round(float(self.frames[..., 1].min()), 4)])
+        np.testing.assert_allclose(trace.node('sta2'), self.frames[:, 1], atol=1e-4)
+
+    def test_binary_slice(self):
+        self.write(BinaryFrameWriter(self.path('t.mntrace'), self.nodes, self.timestep))
+        trace = BinaryTrace(self.path('t.mntrace'))
+        times, frames = trace.slice(1.0, 2.0)
+        self.assertEqual(len(times), 10)
+        self.assertAlmostEqual(times[0], 1.0)
+        self.assertEqual(trace.frame_index(1.05), 10)
+
+    def test_partial_binary_trace_is_readable(self):
+        filename = self.path('t.mntrace')
+        self.write(BinaryFrameWriter(filename, self.nodes, self.timestep))
+        with open(filename, 'r+b') as f:
+            f.truncate(os.path.getsize(filename) - 5)
+        self.assertEqual(len(BinaryTrace(filename)), len(self.frames) - 1)
+
+    def test_compressed_frames_round_trip(self):
+        for codec in ('zlib', 'lzma'):
+            filename = self.path('t_%s.mnz' % codec)
+            self.write(CompressedFrameWriter(filename, self.nodes, self.timestep,
+                                             codec=codec, chunk_frames=16))
+            trace = CompressedTrace(filename)
+            self.assertEqual(len(trace.chunks), 4)
+            times, frames = trace.frames()
+            np.testing.assert_allclose(times, self.times)
+            np.testing.assert_allclose(frames, self.frames, atol=1e-9)
+            times, frames = trace.frames(2.0, 3.0)
+            np.testing.assert_allclose(times, self.times[20:30])
+            trace.close()
+
+    def test_compressed_rows_round_trip(self):
+        filename = self.path('rows.mnz')
+        writer = CompressedRowWriter(filename, self.nodes, chunk_rows=32)
+        for node_id in range(len(self.nodes)):
+            writer.write_rows(node_id, self.times, self.frames[:, node_id])
+        writer.close()
+        trace = CompressedTrace(filename)
+        self.assertEqual(len(trace), len(self.frames) * len(self.nodes))
+        trace.to_csv(self.path('rows.csv'))
+        trace.close()
+        ids, times, xy = read_csv_trace(self.path('rows.csv'))
+        self.assertEqual(ids.tolist(), np.repeat(np.arange(3), 50).tolist())
+        np.testing.assert_allclose(xy, self.frames.transpose(1, 0, 2).reshape(-1, 2))
+
+    def test_csv_binary_conversions(self):
+        self.write(CSVFrameWriter(self.path('t.csv'), self.nodes))
+        self.assertEqual(csv_to_binary(self.path('t.csv'), self.path('t.mntrace')),
+                         len(self.frames))
+        trace = BinaryTrace(self.path('t.mntrace'))
+        self.assertEqual(trace.timestep, self.timestep)
+        np.testing.assert_allclose(trace.data, self.frames, atol=1e-4)
+        binary_to_csv(self.path('t.mntrace'), self.path('back.csv'))
+        with open(self.path('t.csv')) as src, open(self.path('back.csv')) as dst:
+            self.assertEqual(src.read(), dst.read())
+
+    def test_csv_to_binary_timestep_is_per_node(self):
+        # two nodes sampled every second, 50 ms apart from each other
+        with open(self.path('s.csv'), 'w') as f:
+            f.write('node_id,time,x,y\n')
+            for k in range(10):
+                f.write('0,%.2f,%d,0\n1,%.2f,%d,1\n' % (k, k, k + 0.05, k))
+        self.assertEqual(csv_to_binary(self.path('s.csv'), self.path('s.mntrace')), 10)
+        self.assertEqual(BinaryTrace(self.path('s.mntrace')).timestep, 1.0)
+
+    def test_frame_writer_picks_the_format(self):
+        for name, cls in (('t.csv', CSVFrameWriter), ('t.mntrace', BinaryFrameWriter),
+                          ('t.mnz', CompressedFrameWriter)):
+            writer = frame_writer(self.path(name), self.nodes, self.timestep)
+            self.assertIsInstance(writer, cls)
+            writer.close()
+
+    def test_streamer_writes_every_frame_in_order(self):
+        writer = Frames()
+        streamer = TraceStreamer(writer, depth=4)
+        for t, frame in zip(self.times, self.frames):
+            streamer(t, frame)
+        streamer.close()
+        streamer.close()
+        streamer(99.0, self.frames[0])  # dropped once closed
+        self.assertTrue(writer.closed)
+        self.assertEqual([t for t, _ in writer], self.times.tolist())
+        self.assertEqual(streamer.frames, len(self.frames))
+
+
+if __name__ == '__main__':
+    unittest.main()
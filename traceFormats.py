@@ -0,0 +1,499 @@
+# -*- coding: utf-8 -*-
+
+"""Mobility trace formats: the CSV layouts, the binary (.mntrace) and
+compressed (.mnz) traces, their frame writers and converters"""
+
+import json
+import lzma
+import os
+import struct
+import zlib
+from threading import Thread as thread, Lock
+from queue import Queue, Empty
+
+import numpy as np
+
+
+class CSVFrameWriter(object):
+    """Writes frames using the export_mobility_trace_from_nodes layout
+    (node_id,time,x,y) or the model trace one (node_id time x y)"""
+    layouts = {'export': ("node_id,time,x,y\n", '%d,%.2f,%.2f,%.2f'),
+               'model': ("node_id time x y\n", '%d %.2f %.2f %.2f')}
+
+    def __init__(self, filename, nodes, buffering=1 << 20, layout='export', ids=None):
+        """:param ids: node_id column, by default the node indices"""
+        header, self.fmt = self.layouts[layout]
+        self.file = open(filename, 'w', buffering=buffering)
+        self.file.write(header)
+        self.ids = np.arange(len(nodes)) if ids is None else np.asarray(ids)
+
+    def __call__(self, t, array):
+        self.write([t], [array])
+
+    def write(self, times, arrays):
+        "Formats several frames in one go"
+        rows = np.empty((len(times) * len(self.ids), 4))
+        rows[:, 0] = np.tile(self.ids, len(times))
+        rows[:, 1] = np.repeat(times, len(self.ids))
+        rows[:, 2:] = np.concatenate([array[:, :2] for array in arrays])
+        np.savetxt(self.file, rows, fmt=self.fmt)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class TraceStreamer(object):
+    """Frame sink handing the frames over to a writer thread. The mobility
+    loop only copies each frame into a bounded queue (and waits when the
+    writer falls behind); the writer takes whatever frames are queued,
+    writes them with one call and flushes, so that an interrupted run
+    leaves a trace of the frames up to the last batch"""
+
+    def __init__(self, writer, depth=256):
+        """:param writer: object with write(times, arrays), flush, close
+        :param depth: frames queued at most"""
+        self.writer = writer
+        self.queue = Queue(depth)
+        self.closed = False
+        self.lock = Lock()  # no frame may be queued after the sentinel
+        self.error = None
+        self.frames = 0
+        self.thread = thread(name='traceWriter', target=self.drain)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __call__(self, t, array):
+        with self.lock:
+            if not self.closed:
+                self.queue.put((t, np.array(array)))
+
+    def drain(self):
+        done = False
+        while not done:
+            batch = [self.queue.get()]
+            while len(batch) < self.queue.maxsize:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            # close() queues None after the last frame
+            if None in batch:
+                del batch[batch.index(None):]
+                done = True
+            frames = batch
+            if not frames or self.error is not None:
+                continue
+            try:
+                self.writer.write([t for t, _ in frames], [a for _, a in frames])
+                self.writer.flush()
+                self.frames += len(frames)
+            except Exception as error:  # reported by close()
+                self.error = error
+
+    def close(self):
+        "Writes the frames still queued and closes the writer"
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.put(None)
+        self.thread.join()
+        self.writer.close()
+        if self.error is not None:
+            raise self.error
+
+
+class BinaryTrace(object):
+    """Binary trace: an 8 byte magic, the header length (uint32) and a
+    JSON header (node names, t0, timestep, bounds), padded to 64 bytes,
+    then one contiguous frames x nodes x 2 float32 block. The number of
+    frames follows from the file size, so a partial file stays readable"""
+    magic = b'MNTRACE1'
+    extension = '.mntrace'
+    prefix = struct.Struct('<8sI')
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            magic, size = self.prefix.unpack(f.read(self.prefix.size))
+            if magic != self.magic:
+                raise ValueError("%s is not a binary mobility trace" % filename)
+            self.header = json.loads(f.read(size).decode())
+        self.nodes = self.header['nodes']
+        self.t0 = self.header['t0']
+        self.timestep = self.header['timestep']
+        self.bounds = self.header['bounds']  # min_x, min_y, max_x, max_y
+        offset = self.prefix.size + size
+        frame_size = len(self.nodes) * 2 * 4
+        frames = (os.path.getsize(filename) - offset) // frame_size if frame_size else 0
+        self.data = np.memmap(filename, dtype='<f4', mode='r', offset=offset,
+                              shape=(frames, len(self.nodes), 2)) if frames else \
+            np.zeros((0, len(self.nodes), 2), dtype='<f4')
+
+    def __len__(self):
+        return len(self.data)
+
+    def times(self):
+        return self.t0 + np.arange(len(self.data)) * self.timestep
+
+    def frame_index(self, t):
+        "Frame in effect at model time t"
+        return int(np.clip(np.floor((t - self.t0) / self.timestep + 1e-9),
+                           0, len(self.data) - 1))
+
+    def slice(self, start=None, stop=None):
+        """Frames with start <= time < stop
+        returns: (times, frames x nodes x 2 view)"""
+        first = 0 if start is None else \
+            max(int(np.ceil((start - self.t0) / self.timestep - 1e-9)), 0)
+        last = len(self.data) if stop is None else \
+            max(int(np.ceil((stop - self.t0) / self.timestep - 1e-9)), first)
+        return self.times()[first:last], self.data[first:last]
+
+    def node(self, node):
+        """Column of one node
+        :param node: name or index
+        returns: frames x 2 view"""
+        idx = self.nodes.index(node) if isinstance(node, str) else node
+        return self.data[:, idx]
+
+
+class BinaryFrameWriter(object):
+    "Writes frames as a BinaryTrace"
+
+    def __init__(self, filename, nodes, timestep):
+        """:param nodes: nodes or node names, one column each
+        :param timestep: model seconds between two frames"""
+        self.file = open(filename, 'wb')
+        self.header = {'nodes': [str(node) for node in nodes], 't0': None,
+                       'timestep': timestep, 'bounds': None}
+        self.lows = np.full(2, np.inf)
+        self.highs = np.full(2, -np.inf)
+        # room for the bounds and t0 filled in later
+        size = len(json.dumps(self.header)) + 256
+        self.size = size + (-(BinaryTrace.prefix.size + size) % 64)
+        self.write_header()
+
+    def write_header(self):
+        header = json.dumps(self.header).encode().ljust(self.size)
+        self.file.seek(0)
+        self.file.write(BinaryTrace.prefix.pack(BinaryTrace.magic, self.size))
+        self.file.write(header)
+        self.file.seek(0, os.SEEK_END)
+
+    def __call__(self, t, array):
+        self.write([t], [array])
+
+    def write(self, times, arrays):
+        block = np.stack([array[:, :2] for array in arrays]).astype('<f4')
+        if self.header['t0'] is None:
+            self.header['t0'] = float(times[0])
+            self.write_header()
+        if block.size:
+            self.lows = np.minimum(self.lows, block.min(axis=(0, 1)))
+            self.highs = np.maximum(self.highs, block.max(axis=(0, 1)))
+        self.file.write(block.tobytes())
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.header['t0'] is None:
+            self.header['t0'] = 0.0
+        if np.isfinite(self.lows).all():
+            self.header['bounds'] = [round(float(c), 4)
+                                     for c in np.concatenate([self.lows, self.highs])]
+        self.write_header()
+        self.file.close()
+
+
+class CompressedTrace(object):
+    """Compressed trace: coordinates quantized to the centimetres the
+    models round to, delta-encoded along each node's stream and
+    compressed chunk by chunk (zlib or lzma). Every chunk starts from
+    absolute values, so that any chunk decodes on its own. Layouts:
+      frames: whole frames on the timestep grid; times are implicit
+      rows: node_id, time, x, y rows, as export_mobility_trace_from_nodes
+            writes them (time quantized to 10 ms as well)"""
+    magic = b'MNZTRAC1'
+    extension = '.mnz'
+    prefix = struct.Struct('<8sI')
+    # first frame or row, count, time of the first and last one, payload size
+    chunk = struct.Struct('<QIddI')
+    scale = 100.0
+    codecs = {'zlib': (lambda data: zlib.compress(data, 6), zlib.decompress),
+              'lzma': (lzma.compress, lzma.decompress)}
+
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        magic, size = self.prefix.unpack(self.file.read(self.prefix.size))
+        if magic != self.magic:
+            raise ValueError("%s is not a compressed mobility trace" % filename)
+        self.header = json.loads(self.file.read(size).decode())
+        self.layout = self.header['layout']
+        self.nodes = self.header['nodes']
+        self.timestep = self.header.get('timestep')
+        self.decompress = self.codecs[self.header['codec']][1]
+        # only the chunk headers are read; a truncated last chunk is ignored
+        self.chunks = []  # (payload offset, first, count, t first, t last, size)
+        end = os.path.getsize(filename)
+        offset = self.file.tell()
+        while offset + self.chunk.size <= end:
+            self.file.seek(offset)
+            first, count, t_first, t_last, length = self.chunk.unpack(
+                self.file.read(self.chunk.size))
+            offset += self.chunk.size
+            if offset + length > end:
+                break
+            self.chunks.append((offset, first, count, t_first, t_last, length))
+            offset += length
+
+    @classmethod
+    def write_header(cls, f, header):
+        data = json.dumps(header).encode()
+        f.write(cls.prefix.pack(cls.magic, len(data)))
+        f.write(data)
+
+    @classmethod
+    def write_chunk(cls, f, compress, first, t_first, t_last, columns):
+        "columns: integer arrays, each delta-encoded along its last axis"
+        count = columns[0].shape[-1]
+        deltas = []
+        for column in columns:
+            delta = np.diff(column, axis=-1, prepend=0)
+            deltas.append(delta.astype(column.dtype).tobytes())
+        payload = compress(b''.join(deltas))
+        f.write(cls.chunk.pack(first, count, t_first, t_last, len(payload)))
+        f.write(payload)
+
+    def close(self):
+        self.file.close()
+
+    def __len__(self):
+        return sum(chunk[2] for chunk in self.chunks)
+
+    def payload(self, idx):
+        offset, length = self.chunks[idx][0], self.chunks[idx][5]
+        self.file.seek(offset)
+        return self.decompress(self.file.read(length))
+
+    def decode(self, idx):
+        """Decodes one chunk
+        returns: frames: (times, frames x nodes x 2)
+                 rows: (node ids, times, rows x 2)"""
+        data = self.payload(idx)
+        count, t_first = self.chunks[idx][2], self.chunks[idx][3]
+        if self.layout == 'frames':
+            q = np.frombuffer(data, '<i4').reshape(len(self.nodes), 2, count)
+            xy = np.cumsum(q, axis=-1).transpose(2, 0, 1) / self.scale
+            return t_first + np.arange(count) * self.timestep, xy
+        ids = np.cumsum(np.frombuffer(data, '<i4', count, 0))
+        t = np.cumsum(np.frombuffer(data, '<i8', count, 4 * count)) / self.scale
+        q = np.frombuffer(data, '<i4', 2 * count, 12 * count).reshape(2, count)
+        return ids, t, (np.cumsum(q, axis=-1) / self.scale).T
+
+    def select(self, start=None, stop=None):
+        "Chunks holding times in [start, stop)"
+        return [idx for idx, chunk in enumerate(self.chunks)
+                if (start is None or chunk[4] >= start)
+                and (stop is None or chunk[3] < stop)]
+
+    def frames(self, start=None, stop=None):
+        """Frames with start <= time < stop, decoding only their chunks
+        returns: (times, frames x nodes x 2)"""
+        times, frames = [np.zeros(0)], [np.zeros((0, len(self.nodes), 2))]
+        for idx in self.select(start, stop):
+            t, xy = self.decode(idx)
+            mask = np.ones(len(t), bool)
+            if start is not None:
+                mask &= t >= start - 1e-9
+            if stop is not None:
+                mask &= t < stop - 1e-9
+            times.append(t[mask])
+            frames.append(xy[mask])
+        return np.concatenate(times), np.concatenate(frames)
+
+    def to_csv(self, dst, layout='export'):
+        "Writes the trace back in a CSV layout; returns the number of rows"
+        writer = CSVFrameWriter(dst, self.nodes, layout=layout)
+        try:
+            for idx in range(len(self.chunks)):
+                if self.layout == 'frames':
+                    times, xy = self.decode(idx)
+                    writer.write(times, xy)
+                else:
+                    ids, t, xy = self.decode(idx)
+                    np.savetxt(writer.file, np.column_stack([ids, t, xy]),
+                               fmt=writer.fmt)
+        finally:
+            writer.close()
+        return len(self)
+
+
+class CompressedFrameWriter(object):
+    "Writes frames as a CompressedTrace, chunk_frames frames per chunk"
+
+    def __init__(self, filename, nodes, timestep, codec='zlib', chunk_frames=600):
+        self.file = open(filename, 'wb')
+        self.compress = CompressedTrace.codecs[codec][0]
+        self.chunk_frames = chunk_frames
+        self.nr_nodes = len(nodes)
+        self.frames = 0
+        self.times, self.pending = [], []
+        CompressedTrace.write_header(self.file, {
+            'layout': 'frames', 'codec': codec, 'timestep': timestep,
+            'nodes': [str(node) for node in nodes]})
+
+    def __call__(self, t, array):
+        self.write([t], [array])
+
+    def write(self, times, arrays):
+        for t, array in zip(times, arrays):
+            self.times.append(float(t))
+            self.pending.append(np.asarray(array)[:, :2])
+            if len(self.pending) == self.chunk_frames:
+                self.write_chunk()
+
+    def write_chunk(self):
+        if not self.pending:
+            return
+        q = np.rint(np.stack(self.pending) * CompressedTrace.scale).astype('<i4')
+        # node-major streams: x and y of one node are contiguous in time
+        CompressedTrace.write_chunk(self.file, self.compress, self.frames,
+                                    self.times[0], self.times[-1],
+                                    [np.ascontiguousarray(q.transpose(1, 2, 0))])
+        self.frames += len(self.pending)
+        self.times, self.pending = [], []
+
+    def flush(self):
+        "Completed chunks only: a chunk is written once full"
+        self.file.flush()
+
+    def close(self):
+        self.write_chunk()
+        self.file.close()
+
+
+class CompressedRowWriter(object):
+    "Writes node_id, time, x, y rows as a CompressedTrace"
+
+    def __init__(self, filename, nodes, codec='zlib', chunk_rows=1 << 16):
+        self.file = open(filename, 'wb')
+        self.compress = CompressedTrace.codecs[codec][0]
+        self.chunk_rows = chunk_rows
+        self.rows = 0
+        self.pending = []
+        self.size = 0
+        CompressedTrace.write_header(self.file, {
+            'layout': 'rows', 'codec': codec,
+            'nodes': [str(node) for node in nodes]})
+
+    def write_rows(self, node_id, times, xy):
+        "Rows of one node, in time order"
+        self.pending.append((np.full(len(times), node_id, '<i4'),
+                             np.asarray(times, float), np.asarray(xy, float)[:, :2]))
+        self.size += len(times)
+        while self.size >= self.chunk_rows:
+            self.write_chunk(self.chunk_rows)
+
+    def write_chunk(self, count):
+        ids, t, xy = [np.concatenate(column) for column in zip(*self.pending)]
+        rest = (ids[count:], t[count:], xy[count:])
+        ids, t, xy = ids[:count], t[:count], xy[:count]
+        self.pending = [rest] if len(rest[0]) else []
+        self.size = len(rest[0])
+        if not len(ids):
+            return
+        CompressedTrace.write_chunk(
+            self.file, self.compress, self.rows, float(t.min()), float(t.max()),
+            [ids, np.rint(t * CompressedTrace.scale).astype('<i8'),
+             np.ascontiguousarray(np.rint(xy.T * CompressedTrace.scale).astype('<i4'))])
+        self.rows += len(ids)
+
+    def close(self):
+        if self.pending:
+            self.write_chunk(self.size)
+        self.file.close()
+
+
+def frame_writer(filename, nodes, timestep, trace_format=None):
+    """Frame writer for a trace file
+    :param trace_format: 'csv', 'binary' or 'compressed' ('zlib' or
+    'lzma' for a given codec); by default picked from the file extension"""
+    if trace_format is None:
+        trace_format = 'binary' if filename.endswith(BinaryTrace.extension) else \
+            'compressed' if filename.endswith(CompressedTrace.extension) else 'csv'
+    if trace_format == 'binary':
+        return BinaryFrameWriter(filename, nodes, timestep)
+    if trace_format in ('compressed', 'zlib', 'lzma'):
+        codec = 'zlib' if trace_format == 'compressed' else trace_format
+        return CompressedFrameWriter(filename, nodes, timestep, codec=codec)
+    if trace_format == 'csv':
+        return CSVFrameWriter(filename, nodes)
+    raise ValueError("Unknown trace format %s" % trace_format)
+
+
+def read_csv_trace(filename):
+    """Reads the export layout (node_id,time,x,y) or the layout of the
+    per-model trace_*.csv files (node_id time x y)
+    returns: (node ids, times, positions) columns"""
+    with open(filename) as f:
+        header = f.readline()
+        delimiter = ',' if ',' in header else None
+        rows = np.loadtxt(f, delimiter=delimiter, ndmin=2)
+    if not len(rows):
+        return np.zeros(0, int), np.zeros(0), np.zeros((0, 2))
+    return rows[:, 0].astype(int), rows[:, 1], rows[:, 2:4]
+
+
+def csv_to_binary(src, dst, timestep=None):
+    """Converts a CSV trace into a BinaryTrace. Rows are put in the frame
+    of their time; nodes keep their last position in the frames they
+    have no row in
+    :param timestep: frame length; by default the median time between
+    two rows of the same node, which rows of different nodes falling
+    between each other's do not shorten
+    returns: number of frames (positions before the first row of a node
+    are NaN)"""
+    ids, times, xy = read_csv_trace(src)
+    nodes = np.unique(ids)
+    if timestep is None:
+        order = np.lexsort((times, ids))
+        steps = np.diff(times[order])[np.diff(ids[order]) == 0]
+        steps = steps[steps > 0]
+        timestep = round(float(np.median(steps)), 6) if len(steps) else 1.0
+    t0 = float(times.min()) if len(times) else 0.0
+    frame = np.rint((times - t0) / timestep).astype(int) if len(times) else times.astype(int)
+    nr_frames = int(frame.max()) + 1 if len(frame) else 0
+    data = np.full((nr_frames, len(nodes), 2), np.nan, dtype='<f4')
+    data[frame, np.searchsorted(nodes, ids)] = xy
+    for n in range(1, nr_frames):
+        gaps = np.isnan(data[n])
+        data[n][gaps] = data[n - 1][gaps]
+    writer = BinaryFrameWriter(dst, ['%d' % node for node in nodes], timestep)
+    try:
+        writer.write(t0 + np.arange(nr_frames) * timestep, list(data))
+    finally:
+        writer.close()
+    return nr_frames
+
+
+def binary_to_csv(src, dst, layout='export'):
+    """Converts a BinaryTrace into a CSV trace
+    :param layout: 'export' (node_id,time,x,y) or 'model' (node_id time x y)"""
+    trace = BinaryTrace(src)
+    try:
+        ids = [int(name) for name in trace.nodes]
+    except ValueError:
+        ids = None
+    writer = CSVFrameWriter(dst, trace.nodes, layout=layout, ids=ids)
+    times = trace.times()
+    chunk = max((1 << 16) // max(len(trace.nodes), 1), 1)
+    try:
+        for first in range(0, len(trace), chunk):
+            writer.write(times[first:first + chunk], trace.data[first:first + chunk])
+    finally:
+        writer.close()
+    return len(trace)